@@ -1,48 +1,108 @@
-import time
+import io, threading, time
+from concurrent.futures import Future
 
 import telegram
 
 import settings
+from meetg.caching import file_id_cache, get_content_hash, read_file_input
+from meetg.coalescing import MessageCoalescer
+from meetg.debouncing import EditDebouncer
+from meetg.delivering import NOT_FOUND, get_undeliverable_state
+from meetg.imaging import image_pipeline
 from meetg.loging import get_logger
+from meetg.retrying import get_backoff_delay, get_circuit_breaker
+from meetg.scheduling import delay_queue
+from meetg.stats import ApiMethodStats, service_cache
 from meetg.storage import db
 from meetg.utils import get_current_unixtime
 
 
 logger = get_logger()
 
+_stats_lock = threading.Lock()
 
-class ApiMethod:
 
-    def __init__(self, tgbot, raise_exception=None):
-        self.tgbot = tgbot
-        self.is_mock = settings.is_test
+class ApiCall:
+    """
+    Per-call state of an API method. ApiMethod objects are created
+    once per bot and shared by threads, so everything related to
+    a particular call lives here
+    """
+    __slots__ = (
+        'method', 'args', 'raise_exception', 'raised', 'attempts', 'attempts_left', 'error',
+        'success', 'response', 'file_hash', 'started_at',
+    )
+
+    def __init__(self, method, raise_exception=None):
+        self.method = method
+        self.args = None
         self.raise_exception = raise_exception
         self.raised = False
-        self.args = None
+        self.attempts = 0
+        self.attempts_left = 0
+        self.error = None
+        self.success = False
+        self.response = None
+        self.file_hash = None
+        self.started_at = None
+
+    @property
+    def name(self):
+        return self.method.name
+
+    def __str__(self):
+        if self.args:
+            return f'{self.name}: {self.args}'
+        else:
+            return f'{self.name}: no args'
+
 
-    def easy_call(self, *args, **kwargs):
+class ApiMethod:
+    # whether calls of the method count against Telegram rate limits
+    rate_limited = True
+    # Outbox object, if calls of the method are sent through it
+    outbox = None
+    # whether calls to chats known as undeliverable are skipped, and such chats are tracked
+    checks_deliverability = False
+    # DeliverabilityIndex object of the bot
+    deliverability = None
+    # ChatMigrationRegistry object of the bot
+    migrations = None
+    # ApiResponseCache object of the bot, used by read-only methods
+    cache = None
+
+    def __init__(self, tgbot, rate_limiter=None):
+        self.tgbot = tgbot
+        self.rate_limiter = rate_limiter
+        self.is_mock = settings.is_test
+        self._tgbot_method = None if self.is_mock else getattr(tgbot, self.name)
+
+    def easy_call(self, record, *args, **kwargs):
         """Call the method by simplified params"""
         raise NotImplementedError
 
     def log(self, kwargs):
         raise NotImplementedError
 
-    def call(self, **kwargs):
+    def call(self, record, **kwargs):
         """
         Call the method by the exact Telegram API params,
         by keyword arguments only, to easily validate them
         """
-        self.args = self._validate(kwargs)
-        success, response = self._call(self.args)
-        if success:
-            self.log(self.args)
-        return success, response
+        record.args = self._validate(kwargs)
+        self.prepare(record)
+        if self.outbox:
+            future = self.outbox.put(record)
+            if future is not None:
+                return future
+        return self._call(record)
+
+    def send_now(self, record):
+        """Make the call in this thread, without holding it to merge with others"""
+        return ApiMethod._call(self, record)
 
     def __str__(self):
-        if self.args:
-            return f'{self.name}: {self.args}'
-        else:
-            return f'{self.name}: no args'
+        return self.name
 
     def _get_parse_mode(self, html, markdown, markdown_v2):
         parse_mode = None
@@ -54,97 +114,237 @@ class ApiMethod:
             parse_mode = telegram.ParseMode.MARKDOWN_V2
         return parse_mode
 
-    def _get_method(self):
+    def _get_method(self, record):
         if self.is_mock:
 
             def tgbot_method(**kwargs):
-                if self.raise_exception is not None and not self.raised:
-                    self.raised = True
-                    raise self.raise_exception
+                if record.raise_exception is not None and not record.raised:
+                    record.raised = True
+                    raise record.raise_exception
                 return ''
 
         else:
-            tgbot_method = getattr(self.tgbot, self.name)
+            tgbot_method = self._tgbot_method
 
         return tgbot_method
 
-    def _call(self, kwargs):
+    def _call(self, record):
         """
-        Retries, handling network and load issues
+        Retries, handling network and load issues. In the "schedule" retry mode
+        a failed call is retried by the delay queue, not to block the thread,
+        and a Future with the result is returned
         """
-        to_attempt = settings.api_attempts
-        success, response = False, None
-        tgbot_method = self._get_method()
-
-        while to_attempt > 0:
-            try:
-                response = tgbot_method(**kwargs)
-                success = True
-                to_attempt = 0
-            except telegram.error.NetworkError as exc:
-                success, to_attempt = self._handle_network_error(exc, success, to_attempt)
-                response = exc.message
-            except telegram.error.TimedOut as exc:
-                logger.error('Timed Out. Retrying')
-                response = exc.message
-                to_attempt -= 1
-            except telegram.error.RetryAfter as exc:
-                logger.error('It is asked to retry after %s seconds. Doing', exc.retry_after)
-                response = exc.message
-                to_attempt -= 2
-                time.sleep(exc.retry_after + 1)
-            except telegram.error.ChatMigrated as exc:
-                logger.error('ChatMigrated error: "%s". Retrying with new chat id', exc)
-                response = exc.message
-                kwargs['chat_id'] = exc.new_chat_id
-                to_attempt -= 1
-            except (telegram.error.Unauthorized, telegram.error.BadRequest) as exc:
-                success, to_attempt = self._handle_unauthorized_or_bad(exc, success, to_attempt)
-                response = exc.message
-
-        logger.debug('Success' if success else 'Fail')
-        return success, response
-
-    def _handle_network_error(self, exc, success, to_attempt):
-        success = False
+        record.attempts_left = settings.api_attempts
+        record.started_at = time.monotonic()
+        delay = self._attempt(record)
+
+        if settings.api_retry_mode == 'schedule':
+            future = Future()
+            if delay is None:
+                future.set_result(self._finish(record))
+            else:
+                delay_queue.schedule(delay, self._retry_later, record, future)
+            return future
+
+        while delay is not None:
+            time.sleep(delay)
+            delay = self._attempt(record)
+        return self._finish(record)
+
+    def _retry_later(self, record, future):
+        """Make the next attempt, and finish the call if it's the last one"""
+        try:
+            delay = self._attempt(record)
+            if delay is None:
+                future.set_result(self._finish(record))
+            else:
+                delay_queue.schedule(delay, self._retry_later, record, future)
+        except Exception as exc:
+            # otherwise whoever waits for the result would wait forever
+            future.set_exception(exc)
+
+    def _attempt(self, record):
+        """
+        Make one attempt of the call. Return the number of seconds
+        to wait before the next attempt, or None if no more attempts needed
+        """
+        kwargs = record.args
+        tgbot_method = self._get_method(record)
+        breaker = get_circuit_breaker(self.name)
+        delay = 0
+        self._resolve_migrated(kwargs)
+
+        state = self._get_undeliverable_state(kwargs.get('chat_id'))
+        if state:
+            logger.warning('Chat %s is %s, skipping %s', kwargs.get('chat_id'), state, self.name)
+            record.success = False
+            record.response = f'Chat is {state}'
+            return None
+
+        if breaker and not breaker.allow():
+            logger.error('Circuit breaker for %s is open, failing fast', self.name)
+            record.success = False
+            record.response = f'Circuit breaker for {self.name} is open'
+            return None
+
+        record.attempts += 1
+        self._throttle(kwargs)
+        try:
+            record.response = tgbot_method(**kwargs)
+            record.success = True
+            record.attempts_left = 0
+        except telegram.error.NetworkError as exc:
+            delay = self._handle_network_error(exc, record)
+            record.error = exc
+            record.response = exc.message
+        except telegram.error.TimedOut as exc:
+            logger.error('Timed Out. Retrying')
+            record.error = exc
+            record.response = exc.message
+            record.attempts_left -= 1
+        except telegram.error.RetryAfter as exc:
+            logger.error('It is asked to retry after %s seconds. Doing', exc.retry_after)
+            record.error = exc
+            record.response = exc.message
+            record.attempts_left -= 2
+            if self.rate_limiter:
+                self.rate_limiter.hold(kwargs.get('chat_id'), exc.retry_after + 1)
+            delay = exc.retry_after + 1
+            self._get_stats().add_retry_after(delay)
+        except telegram.error.ChatMigrated as exc:
+            logger.error('ChatMigrated error: "%s". Retrying with new chat id', exc)
+            record.error = exc
+            record.response = exc.message
+            if self.migrations:
+                self.migrations.register(kwargs['chat_id'], exc.new_chat_id)
+            kwargs['chat_id'] = exc.new_chat_id
+            record.attempts_left -= 1
+        except (telegram.error.Unauthorized, telegram.error.BadRequest) as exc:
+            self._handle_unauthorized_or_bad(exc, record)
+            record.error = exc
+            record.response = exc.message
+        except Exception:
+            # otherwise a half-open breaker would wait for the result of its probe forever
+            if breaker:
+                breaker.release_probe()
+            raise
+
+        if breaker:
+            self._update_circuit_breaker(breaker, record)
+        if record.attempts_left > 0:
+            return delay
+
+    def _finish(self, record):
+        """Complete the call when no more attempts needed"""
+        logger.debug('Success' if record.success else 'Fail')
+        duration = time.monotonic() - record.started_at
+        self._get_stats().add_call(record.success, record.attempts, duration)
+        if record.success:
+            self.log(record.args)
+        elif self.deliverability and self.checks_deliverability:
+            state = get_undeliverable_state(record.error)
+            if state == NOT_FOUND and 'from_chat_id' in self.parameters:
+                # the chat not found may be the one messages are taken from
+                state = None
+            if state:
+                self.deliverability.mark(record.args.get('chat_id'), state)
+        self.handle_result(record)
+        return record.success, record.response
+
+    def _get_stats(self):
+        stats = service_cache['stats']['api']
+        method_stats = stats.get(self.name)
+        if method_stats is None:
+            with _stats_lock:
+                method_stats = stats.get(self.name)
+                if method_stats is None:
+                    method_stats = ApiMethodStats()
+                    stats[self.name] = method_stats
+        return method_stats
+
+    def _resolve_migrated(self, kwargs):
+        """Rewrite ids of chats known as migrated to supergroups"""
+        if self.migrations:
+            for key in ('chat_id', 'from_chat_id'):
+                if kwargs.get(key) is not None:
+                    kwargs[key] = self.migrations.resolve(kwargs[key])
+
+    def _get_undeliverable_state(self, chat_id):
+        if self.deliverability and self.checks_deliverability and chat_id is not None:
+            return self.deliverability.get(chat_id)
+
+    def prepare(self, record):
+        """Intended to be redefined to change the args before the call"""
+        pass
+
+    def handle_result(self, record):
+        """Intended to be redefined to react on the call result"""
+        pass
+
+    def _update_circuit_breaker(self, breaker, record):
+        """Only failures of Telegram itself count, not errors in the request"""
+        error = record.error if not record.success else None
+        is_outage = (
+            isinstance(error, telegram.error.NetworkError)
+            and not isinstance(error, telegram.error.BadRequest)
+        )
+        if is_outage:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def _throttle(self, kwargs):
+        """Wait until the call fits in Telegram rate limits"""
+        if self.rate_limiter and self.rate_limited:
+            waited = self.rate_limiter.acquire(kwargs.get('chat_id'))
+            if waited > 0:
+                logger.debug('Waited %.3f seconds to not exceed rate limits', waited)
+
+    def _handle_network_error(self, exc, record):
+        """Return the number of seconds to wait before the next attempt"""
+        record.success = False
+        delay = 0
         prefix = 'Network error: '
 
         if 'are exactly the same as' in exc.message:
-            logger.error(prefix + '"%s". It\'s ok, nothing to do here', exc.message)
-            success = True
-            to_attempt = 0
+            logger.info(prefix + '"%s". It\'s ok, nothing to do here', exc.message)
+            record.success = True
+            record.attempts_left = 0
 
         elif "Can't parse entities" in exc.message:
             logger.error(prefix + '"%s". Retrying is pointless', exc.message)
-            to_attempt = 0
+            record.attempts_left = 0
 
         elif "Message to forward not found" in exc.message:
             logger.error(prefix + '"%s". Retrying is pointless', exc.message)
-            to_attempt = 0
+            record.attempts_left = 0
+
+        elif "Message to delete not found" in exc.message or "can't be deleted" in exc.message:
+            logger.error(prefix + '"%s". Retrying is pointless', exc.message)
+            record.attempts_left = 0
+
+        elif get_undeliverable_state(exc):
+            logger.error(prefix + '"%s". Retrying is pointless', exc.message)
+            record.attempts_left = 0
 
         else:
-            logger.error(
-                prefix + '"%s". Waiting %s seconds then retry',
-                exc.message, settings.network_error_wait
-            )
-            to_attempt -= 1
-            time.sleep(settings.network_error_wait)
+            delay = get_backoff_delay(record.attempts)
+            logger.error(prefix + '"%s". Waiting %.2f seconds then retry', exc.message, delay)
+            record.attempts_left -= 1
 
-        return success, to_attempt
+        return delay
 
-    def _handle_unauthorized_or_bad(self, exc, success, to_attempt):
-        success = False
+    def _handle_unauthorized_or_bad(self, exc, record):
+        record.success = False
 
-        # telegram.error.Unauthorized
-        if 'bot was kicked' in exc.message:
+        # bot was kicked or blocked, chat not found, etc
+        if get_undeliverable_state(exc):
             logger.error(exc)
-            to_attempt = 0
+            record.attempts_left = 0
 
         else:
             logger.error('Error: "%s". Retrying', exc)
-            to_attempt -= 2
-
-        return success, to_attempt
+            record.attempts_left -= 2
 
     def _validate(self, data):
         validated = {}
@@ -158,6 +358,7 @@ class ApiMethod:
 
 class SendMessageMethod(ApiMethod):
     name = 'send_message'
+    checks_deliverability = True
     parameters = (
         # required
         'chat_id', 'text',
@@ -166,24 +367,27 @@ class SendMessageMethod(ApiMethod):
         'reply_to_message_id', 'allow_sending_without_reply', 'reply_markup', 
     )
 
-    def call(self, **kwargs):
-        """If bot was kicked from the chat, update Chat record in storage"""
-        success, response = super().call(**kwargs)
-        if not success and 'bot was kicked' in response:
-            db.Chat.update_one({'id': kwargs['chat_id']}, {'_kicked_at': get_current_unixtime()})
-        return success, response
+    def __init__(self, tgbot, rate_limiter=None):
+        super().__init__(tgbot, rate_limiter)
+        window = settings.coalesce_messages_window
+        self.coalescer = MessageCoalescer(self, window) if window else None
+
+    def _call(self, record):
+        """Messages can be held to merge them with next ones, then a Future is returned"""
+        if self.coalescer and self.coalescer.accepts(record):
+            return self.coalescer.add(record)
+        return self.send_now(record)
 
     def easy_call(
-            self, chat_id, text, reply_to=None, markup=None, preview=False, notify=True,
+            self, record, chat_id, text, reply_to=None, markup=None, preview=False, notify=True,
             force=True, html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, text=text, reply_to_message_id=reply_to, reply_markup=markup,
+        return self.call(
+            record, chat_id=chat_id, text=text, reply_to_message_id=reply_to, reply_markup=markup,
             parse_mode=parse_mode, disable_web_page_preview=not preview,
             disable_notification=not notify, allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -200,16 +404,27 @@ class EditMessageTextMethod(ApiMethod):
         'chat_id', 'message_id', 'inline_message_id', 'parse_mode', 'entities',
         'disable_web_page_preview', 'reply_markup',
     )
+
+    def __init__(self, tgbot, rate_limiter=None):
+        super().__init__(tgbot, rate_limiter)
+        interval = settings.edit_debounce_interval
+        self.debouncer = EditDebouncer(self, interval) if interval else None
+
+    def _call(self, record):
+        """Edits can be debounced, then a Future is returned"""
+        if self.debouncer:
+            return self.debouncer.add(record)
+        return self.send_now(record)
+
     def easy_call(
-            self, text, chat_id, message_id, preview=False,
+            self, record, text, chat_id, message_id, preview=False,
             html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            text=text, chat_id=chat_id, message_id=message_id, parse_mode=parse_mode,
+        return self.call(
+            record, text=text, chat_id=chat_id, message_id=message_id, parse_mode=parse_mode,
             disable_web_page_preview=not preview, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -223,9 +438,8 @@ class DeleteMessageMethod(ApiMethod):
         # required
         'chat_id', 'message_id',
     )
-    def easy_call(self, chat_id, message_id):
-        success, response = self.call(chat_id=chat_id, message_id=message_id)
-        return success, response
+    def easy_call(self, record, chat_id, message_id):
+        return self.call(record, chat_id=chat_id, message_id=message_id)
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -235,18 +449,18 @@ class DeleteMessageMethod(ApiMethod):
 
 class ForwardMessageMethod(ApiMethod):
     name = 'forward_message'
+    checks_deliverability = True
     parameters = (
         # required
         'chat_id', 'from_chat_id', 'message_id',
         # optional
         'disable_notification',
     )
-    def easy_call(self, chat_id, from_chat_id, message_id, notify=True):
-        success, response = self.call(
-            chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
+    def easy_call(self, record, chat_id, from_chat_id, message_id, notify=True):
+        return self.call(
+            record, chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
             disable_notification=not notify,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -258,8 +472,54 @@ class ForwardMessageMethod(ApiMethod):
         )
 
 
-class SendPhotoMethod(ApiMethod):
+class SendFileMethod(ApiMethod):
+    """
+    Base class for methods uploading a file. If the same content was uploaded
+    before, its file_id is sent instead, so the content isn't uploaded again
+    """
+    checks_deliverability = True
+    # the arg with the file, and the field of the sent Message with the uploaded file
+    file_field = None
+
+    def prepare(self, record):
+        if not settings.cache_file_ids and not settings.process_images:
+            return
+        content, to_send = read_file_input(record.args.get(self.file_field))
+        if content is None:
+            return
+
+        if settings.cache_file_ids:
+            # hash of the original content, so cache hits skip processing too
+            content_hash = get_content_hash(content)
+            file_id = file_id_cache.get(self.file_field, content_hash)
+            if file_id:
+                logger.debug('Sending cached file_id instead of the %s content', self.file_field)
+                record.args[self.file_field] = file_id
+                return
+            record.file_hash = content_hash
+
+        if settings.process_images:
+            to_send = self.process_content(record, content, to_send)
+        record.args[self.file_field] = to_send
+
+    def process_content(self, record, content, to_send):
+        """Intended to be redefined to process the content, return the value to send"""
+        return to_send
+
+    def handle_result(self, record):
+        """Remember file_id of the uploaded content"""
+        if record.success and record.file_hash:
+            uploaded = getattr(record.response, self.file_field, None)
+            if isinstance(uploaded, list):
+                # photo sizes, the original one is the last
+                uploaded = uploaded[-1] if uploaded else None
+            if uploaded:
+                file_id_cache.set(self.file_field, record.file_hash, uploaded.file_id)
+
+
+class SendPhotoMethod(SendFileMethod):
     name = 'send_photo'
+    file_field = 'photo'
     parameters = (
         # required
         'chat_id', 'photo',
@@ -269,24 +529,33 @@ class SendPhotoMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, photo, reply_to=None, markup=None, notify=True, force=True,
+            self, record, chat_id, photo, reply_to=None, markup=None, notify=True, force=True,
             html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, photo=photo, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, photo=photo, reply_to_message_id=reply_to,
             reply_markup=markup, parse_mode=parse_mode, disable_notification=not notify,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
+
+    def process_content(self, record, content, to_send):
+        processed = image_pipeline.process_photo(content)
+        if processed is content:
+            # not processed, it's sent as is under its own name
+            return to_send
+        processed = io.BytesIO(processed)
+        processed.name = 'photo.jpg'
+        return processed
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
         logger.info('Send photo to chat %s', chat_id)
 
 
-class SendDocumentMethod(ApiMethod):
+class SendDocumentMethod(SendFileMethod):
     name = 'send_document'
+    file_field = 'document'
     parameters = (
         # required
         'chat_id', 'document',
@@ -297,24 +566,31 @@ class SendDocumentMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, document, reply_to=None, markup=None, force=True,
+            self, record, chat_id, document, reply_to=None, markup=None, force=True,
             notify=True, html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, document=document, reply_to_message_id=reply_to, reply_markup=markup,
-            parse_mode=parse_mode, disable_notification=not notify,
+        return self.call(
+            record, chat_id=chat_id, document=document, reply_to_message_id=reply_to,
+            reply_markup=markup, parse_mode=parse_mode, disable_notification=not notify,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
+
+    def process_content(self, record, content, to_send):
+        if record.args.get('thumb') is None:
+            thumb = image_pipeline.make_thumb(content)
+            if thumb:
+                record.args['thumb'] = thumb
+        return to_send
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
         logger.info('Send document to chat %s', chat_id)
 
 
-class SendAnimationMethod(ApiMethod):
+class SendAnimationMethod(SendFileMethod):
     name = 'send_animation'
+    file_field = 'animation'
     parameters = (
         # required
         'chat_id', 'animation',
@@ -325,24 +601,24 @@ class SendAnimationMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, animation, reply_to=None, markup=None, notify=True, force=True,
+            self, record, chat_id, animation, reply_to=None, markup=None, notify=True, force=True,
             html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, animation=animation, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, animation=animation, reply_to_message_id=reply_to,
             reply_markup=markup, disable_notification=not notify, parse_mode=parse_mode,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
         logger.info('Send animation to chat %s', chat_id)
 
 
-class SendAudioMethod(ApiMethod):
+class SendAudioMethod(SendFileMethod):
     name = 'send_audio'
+    file_field = 'audio'
     parameters = (
         # required
         'chat_id', 'audio',
@@ -353,24 +629,24 @@ class SendAudioMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, audio, reply_to=None, markup=None, notify=True, force=True,
+            self, record, chat_id, audio, reply_to=None, markup=None, notify=True, force=True,
             html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, audio=audio, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, audio=audio, reply_to_message_id=reply_to,
             reply_markup=markup, disable_notification=not notify, parse_mode=parse_mode,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
         logger.info('Send audio to chat %s', chat_id)
 
 
-class SendVideoMethod(ApiMethod):
+class SendVideoMethod(SendFileMethod):
     name = 'send_video'
+    file_field = 'video'
     parameters = (
         # required
         'chat_id', 'video',
@@ -381,16 +657,15 @@ class SendVideoMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, video, reply_to=None, markup=None, notify=True, force=True,
+            self, record, chat_id, video, reply_to=None, markup=None, notify=True, force=True,
             html=None, markdown=None, markdown_v2=None, **kwargs,
         ):
         parse_mode = self._get_parse_mode(html, markdown, markdown_v2)
-        success, response = self.call(
-            chat_id=chat_id, video=video, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, video=video, reply_to_message_id=reply_to,
             reply_markup=markup, disable_notification=not notify, parse_mode=parse_mode,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -399,6 +674,7 @@ class SendVideoMethod(ApiMethod):
 
 class SendStickerMethod(ApiMethod):
     name = 'send_sticker'
+    checks_deliverability = True
     parameters = (
         # required
         'chat_id', 'sticker',
@@ -408,14 +684,14 @@ class SendStickerMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, sticker, reply_to=None, markup=None, notify=True, force=True, **kwargs,
+            self, record, chat_id, sticker, reply_to=None, markup=None, notify=True, force=True,
+            **kwargs,
         ):
-        success, response = self.call(
-            chat_id=chat_id, sticker=sticker, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, sticker=sticker, reply_to_message_id=reply_to,
             reply_markup=markup, disable_notification=not notify,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -424,6 +700,7 @@ class SendStickerMethod(ApiMethod):
 
 class SendContactMethod(ApiMethod):
     name = 'send_contact'
+    checks_deliverability = True
     parameters = (
         # required
         'chat_id', 'phone_number', 'first_name',
@@ -433,15 +710,14 @@ class SendContactMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, phone_number, first_name, reply_to=None, markup=None, notify=True,
-            force=True, **kwargs,
+            self, record, chat_id, phone_number, first_name, reply_to=None, markup=None,
+            notify=True, force=True, **kwargs,
         ):
-        success, response = self.call(
-            chat_id=chat_id, phone_number=phone_number, first_name=first_name,
+        return self.call(
+            record, chat_id=chat_id, phone_number=phone_number, first_name=first_name,
             reply_to_message_id=reply_to, reply_markup=markup, disable_notification=not notify,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -451,6 +727,7 @@ class SendContactMethod(ApiMethod):
 
 class SendLocationMethod(ApiMethod):
     name = 'send_location'
+    checks_deliverability = True
     parameters = (
         # required
         'chat_id', 'latitude', 'longitude',
@@ -461,14 +738,14 @@ class SendLocationMethod(ApiMethod):
     )
 
     def easy_call(
-            self, chat_id, lat, lon, reply_to=None, markup=None, notify=True, force=True, **kwargs,
+            self, record, chat_id, lat, lon, reply_to=None, markup=None, notify=True, force=True,
+            **kwargs,
         ):
-        success, response = self.call(
-            chat_id=chat_id, latitude=lat, longitude=lon, reply_to_message_id=reply_to,
+        return self.call(
+            record, chat_id=chat_id, latitude=lat, longitude=lon, reply_to_message_id=reply_to,
             reply_markup=markup, disable_notification=not notify,
             allow_sending_without_reply=force, **kwargs,
         )
-        return success, response
 
     def log(self, kwargs):
         chat_id = kwargs.get('chat_id')
@@ -477,6 +754,203 @@ class SendLocationMethod(ApiMethod):
         logger.info('Send location (%s, %s) to chat %s', lat, lon, chat_id)
 
 
+class SendMediaGroupMethod(ApiMethod):
+    name = 'send_media_group'
+    checks_deliverability = True
+    parameters = (
+        # required
+        'chat_id', 'media',
+        # optional
+        'disable_notification', 'reply_to_message_id', 'allow_sending_without_reply',
+    )
+    min_group_size = 2
+    max_group_size = 10
+    # methods of the bot, set by it, to send items which can't be in a group
+    methods = None
+    # factory of call records of the bot, set by it, for calls after the first one
+    new_api_call = ApiCall
+
+    def _get_input_media(self, item):
+        """Items which aren't InputMedia objects are photos"""
+        if isinstance(item, telegram.InputMedia):
+            return item
+        to_send = read_file_input(item)[1]
+        return telegram.InputMediaPhoto(to_send)
+
+    def _get_segments(self, media):
+        """
+        Split media into runs which can be in one group: documents and audios can't be mixed.
+        Animations can't be in groups at all, each is a run of its own
+        """
+        segments = []
+        for item in media:
+            if item.type == 'animation':
+                segments.append((item.type, [item]))
+                continue
+            kind = item.type if item.type in ('document', 'audio') else 'visual'
+            if segments and segments[-1][0] == kind:
+                segments[-1][1].append(item)
+            else:
+                segments.append((kind, [item]))
+        return [items for kind, items in segments]
+
+    def split(self, media):
+        """
+        Split media into groups of allowed sizes, in the same order. An item which
+        can't be grouped, like a document between photos, is a group of one
+        """
+        groups = []
+        for items in self._get_segments(media):
+            chunks = [
+                items[start:start + self.max_group_size]
+                for start in range(0, len(items), self.max_group_size)
+            ]
+            if len(chunks) > 1 and len(chunks[-1]) < self.min_group_size:
+                # take one from the previous full chunk, 10 + 1 becomes 9 + 2
+                chunks[-1].insert(0, chunks[-2].pop())
+            groups.extend(chunks)
+        return groups
+
+    def _send_single(self, record, chat_id, item, **kwargs):
+        """Send a lone item by the method of its type, like send_document"""
+        method = self.methods[f'send_{item.type}']
+        file_input = item.media
+        if isinstance(file_input, telegram.InputFile):
+            file_input = io.BytesIO(file_input.input_file_content)
+            file_input.name = item.media.filename
+        kwargs[item.type] = file_input
+        for name in ('caption', 'parse_mode', 'caption_entities', 'thumb'):
+            value = getattr(item, name, None)
+            if value is not None and name in method.parameters:
+                kwargs[name] = value
+        record = self.new_api_call(method, record.raise_exception)
+        return method.call(record, chat_id=chat_id, **kwargs)
+
+    def easy_call(self, record, chat_id, media, reply_to=None, notify=True, force=True, **kwargs):
+        """
+        Send a list of InputMedia objects, or files to send as photos, as albums.
+        The list is split into groups of 2-10 items, documents and audios
+        in their own groups, a lone item is sent by its own method.
+        Return a list of results of the groups
+        """
+        media = [self._get_input_media(item) for item in media]
+        results = []
+        for number, group in enumerate(self.split(media)):
+            if number:
+                record = self.new_api_call(self, record.raise_exception)
+                reply_to = None
+            call_kwargs = dict(
+                kwargs, reply_to_message_id=reply_to, disable_notification=not notify,
+                allow_sending_without_reply=force,
+            )
+            if len(group) == 1:
+                result = self._send_single(record, chat_id, group[0], **call_kwargs)
+            else:
+                result = self.call(record, chat_id=chat_id, media=group, **call_kwargs)
+            results.append(result)
+        return results
+
+    def log(self, kwargs):
+        chat_id = kwargs.get('chat_id')
+        logger.info('Send media group of %s to chat %s', len(kwargs.get('media')), chat_id)
+
+
+class ReadOnlyMethod(ApiMethod):
+    """
+    Base class for methods only getting info. Successful responses are cached
+    for the TTL set in settings.api_cache_ttl, by the method and args
+    """
+    rate_limited = False
+
+    def _call(self, record):
+        ttl = settings.api_cache_ttl.get(self.name)
+        if not self.cache or not ttl:
+            return self._call_now(record)
+        key = (self.name, tuple(sorted(record.args.items())))
+        chat_id = record.args.get('chat_id')
+        result = self.cache.get_or_call(key, chat_id, ttl, lambda: self._call_now(record))
+        record.success, record.response = result
+        return result
+
+    def _call_now(self, record):
+        result = super()._call(record)
+        if isinstance(result, Future):
+            # callers need the info right away
+            result = result.result()
+        return result
+
+
+class GetMeMethod(ReadOnlyMethod):
+    name = 'get_me'
+    parameters = ()
+
+    def _call_now(self, record):
+        """The bot info is also kept in storage, to not request it on each start"""
+        ttl = settings.api_cache_ttl.get(self.name) or 0
+        stored = db.State.get('me')
+        # the token may be changed to one of another bot
+        bot_id = settings.tg_api_token.split(':')[0]
+        is_same_bot = stored and str(stored['user']['id']) == bot_id
+        if is_same_bot and stored['saved_at'] + ttl > get_current_unixtime():
+            record.success = True
+            record.response = telegram.User.de_json(stored['user'], self.tgbot)
+            return record.success, record.response
+
+        result = super()._call_now(record)
+        if record.success and not self.is_mock:
+            me = {'user': record.response.to_dict(), 'saved_at': get_current_unixtime()}
+            db.State.set('me', me)
+        return result
+
+    def easy_call(self, record):
+        return self.call(record)
+
+    def log(self, kwargs):
+        logger.info('Get bot info')
+
+
+class GetChatMethod(ReadOnlyMethod):
+    name = 'get_chat'
+    parameters = (
+        # required
+        'chat_id',
+    )
+
+    def easy_call(self, record, chat_id):
+        return self.call(record, chat_id=chat_id)
+
+    def log(self, kwargs):
+        logger.info('Get chat %s', kwargs.get('chat_id'))
+
+
+class GetChatMemberMethod(ReadOnlyMethod):
+    name = 'get_chat_member'
+    parameters = (
+        # required
+        'chat_id', 'user_id',
+    )
+
+    def easy_call(self, record, chat_id, user_id):
+        return self.call(record, chat_id=chat_id, user_id=user_id)
+
+    def log(self, kwargs):
+        logger.info('Get member %s of chat %s', kwargs.get('user_id'), kwargs.get('chat_id'))
+
+
+class GetChatAdministratorsMethod(ReadOnlyMethod):
+    name = 'get_chat_administrators'
+    parameters = (
+        # required
+        'chat_id',
+    )
+
+    def easy_call(self, record, chat_id):
+        return self.call(record, chat_id=chat_id)
+
+    def log(self, kwargs):
+        logger.info('Get administrators of chat %s', kwargs.get('chat_id'))
+
+
 api_methods = {
     'send_message': SendMessageMethod,
     'send_photo': SendPhotoMethod,
@@ -490,4 +964,9 @@ api_methods = {
     'send_video': SendVideoMethod,
     'send_contact': SendContactMethod,
     'send_location': SendLocationMethod,
+    'send_media_group': SendMediaGroupMethod,
+    'get_me': GetMeMethod,
+    'get_chat': GetChatMethod,
+    'get_chat_member': GetChatMemberMethod,
+    'get_chat_administrators': GetChatAdministratorsMethod,
 }
@@ -0,0 +1,255 @@
+"""
+Load testing of a bot: replaying stored updates and measuring the throughput
+"""
+import random, time
+from collections import defaultdict
+
+import psutil, telegram
+
+import settings
+from meetg.factories import MessageUpdateFactory
+from meetg.loging import get_logger
+from meetg.routing import MESSAGE_UPDATE_TYPES
+from meetg.storage import db
+from meetg.utils import import_string
+
+
+logger = get_logger()
+
+
+def get_percentile(values, percent):
+    """Return the percentile of already sorted values, by the nearest-rank method"""
+    if not values:
+        return 0
+    rank = max(int(round(percent / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+class LatencyStats:
+    """Durations of processed updates, grouped by the handler which processed them"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.total = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+
+    def add(self, handler_name, duration):
+        self.durations[handler_name].append(duration)
+        self.total += 1
+
+    @property
+    def elapsed(self):
+        return self.finished_at - self.started_at
+
+    @property
+    def throughput(self):
+        return self.total / self.elapsed if self.elapsed else 0
+
+    def get_summary(self):
+        summary = {
+            'updates': self.total,
+            'seconds': round(self.elapsed, 3),
+            'updates_per_sec': round(self.throughput, 2),
+            'handlers': {},
+        }
+        for handler_name, durations in self.durations.items():
+            durations = sorted(durations)
+            summary['handlers'][handler_name] = {
+                'count': len(durations),
+                'p50_ms': round(get_percentile(durations, 50) * 1000, 3),
+                'p95_ms': round(get_percentile(durations, 95) * 1000, 3),
+                'p99_ms': round(get_percentile(durations, 99) * 1000, 3),
+                'max_ms': round(durations[-1] * 1000, 3),
+            }
+        return summary
+
+
+def format_summary(summary):
+    lines = [
+        f"Processed {summary['updates']} updates in {summary['seconds']} seconds, "
+        f"{summary['updates_per_sec']} updates/sec",
+    ]
+    for handler_name, stats in summary['handlers'].items():
+        lines.append(
+            f"{handler_name}: {stats['count']} updates, p50 {stats['p50_ms']} ms, "
+            f"p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms, max {stats['max_ms']} ms"
+        )
+    return '\n'.join(lines)
+
+
+def get_handler_name(handler):
+    if handler is None:
+        return 'no handler'
+    return getattr(handler.callback, '__name__', type(handler).__name__)
+
+
+def process_update(bot, update, stats):
+    """Pass the update through the bot, measuring the time it took"""
+    started = time.perf_counter()
+    bot._simulate_process_update(update)
+    duration = time.perf_counter() - started
+    stats.add(get_handler_name(bot.last_handler), duration)
+
+
+def create_test_bot():
+    """Create settings.bot_class instance with mocked Updater and API methods"""
+    settings.is_test = True
+    db.init_models()
+    db.drop()
+    Bot = import_string(settings.bot_class)
+    return Bot()
+
+
+def get_replay_query(since=None, until=None, chat_id=None, update_type=None):
+    query = {}
+    if since is not None or until is not None:
+        query['_created_at'] = {}
+        if since is not None:
+            query['_created_at']['$gte'] = since
+        if until is not None:
+            query['_created_at']['$lt'] = until
+    if chat_id is not None:
+        query['$or'] = [{f'{type_}.chat.id': chat_id} for type_ in MESSAGE_UPDATE_TYPES]
+    if update_type is not None:
+        query[update_type] = {'$exists': True}
+    return query
+
+
+def load_stored_updates(query, batch_size=1000):
+    """
+    Stream raw updates stored by the Update model in the production DB.
+    The cursor fetches them in batches, so memory doesn't grow with the range
+    """
+    Model = import_string(settings.Update_model)
+    model = Model(test=False)
+    cursor = model.find(query).sort('_created_at').batch_size(batch_size)
+    yield from cursor
+
+
+def get_multiplier(speed):
+    """Convert speed to a multiplier of the real time; None means the max throughput"""
+    if speed in (None, 'max'):
+        return None
+    if speed == 'real':
+        return 1.0
+    multiplier = float(speed)
+    if not multiplier > 0:
+        raise ValueError(f'Speed must be positive, got {speed}')
+    return multiplier
+
+
+def replay(since=None, until=None, chat_id=None, update_type=None, speed='max'):
+    """
+    Stream stored updates through the bot against mocked API methods.
+    The stored updates are read from the production DB,
+    while the bot works with the test DB, so production data stays intact
+    """
+    query = get_replay_query(since, until, chat_id, update_type)
+    docs = load_stored_updates(query)
+    multiplier = get_multiplier(speed)
+
+    bot = create_test_bot()
+    stats = LatencyStats()
+    stats.start()
+    first_created_at = None
+
+    for doc in docs:
+        created_at = doc.pop('_created_at')
+        if first_created_at is None:
+            first_created_at = created_at
+        for key in ('_id', '_modified_at'):
+            doc.pop(key, None)
+
+        if multiplier:
+            due = stats.started_at + (created_at - first_created_at) / multiplier
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        update = telegram.Update.de_json(doc, bot._tgbot)
+        process_update(bot, update, stats)
+
+    stats.finish()
+    return stats.get_summary()
+
+
+def generate_updates(tgbot, number):
+    """Generate a corpus of various synthetic updates"""
+    kinds = (
+        ('message', {'text': 'Spam'}),
+        ('message', {'text': '/start'}),
+        ('message', {'text': 'Spam in group', 'chat__id': -1, 'chat__type': 'group'}),
+        ('message', {'photo__width': 100}),
+        ('message', {'document__mime_type': 'image/gif'}),
+        ('edited_message', {'text': 'Edited spam'}),
+    )
+    updates = []
+    for _ in range(number):
+        message_type, kwargs = random.choice(kinds)
+        kwargs = dict(kwargs, from__id=random.randint(1, 1000))
+        if 'chat__id' not in kwargs:
+            kwargs['chat__id'] = kwargs['from__id']
+        factory = MessageUpdateFactory(tgbot, message_type)
+        updates.append(factory.create(**kwargs))
+    return updates
+
+
+def get_rss():
+    return psutil.Process().memory_info().rss
+
+
+def bench_storage(storage_class, number):
+    """Push synthetic updates through the whole pipeline with the storage class"""
+    settings.storage_class = storage_class
+    bot = create_test_bot()
+    updates = generate_updates(bot._tgbot, number)
+
+    rss_before = get_rss()
+    stats = LatencyStats()
+    stats.start()
+    for update in updates:
+        process_update(bot, update, stats)
+    stats.finish()
+
+    summary = stats.get_summary()
+    durations = sorted(d for durations in stats.durations.values() for d in durations)
+    summary.update({
+        'storage_class': storage_class,
+        'p50_ms': round(get_percentile(durations, 50) * 1000, 3),
+        'p95_ms': round(get_percentile(durations, 95) * 1000, 3),
+        'p99_ms': round(get_percentile(durations, 99) * 1000, 3),
+        'memory_growth_mb': round((get_rss() - rss_before) / 1000000, 2),
+    })
+    return summary
+
+
+def bench(number=1000, storage_classes=None):
+    """Measure the throughput of settings.bot_class against each storage backend"""
+    if not storage_classes:
+        storage_classes = settings.bench_storage_classes or (settings.storage_class, )
+    original_storage_class = settings.storage_class
+    results = []
+    try:
+        for storage_class in storage_classes:
+            logger.info('Benchmarking %s updates with %s', number, storage_class)
+            results.append(bench_storage(storage_class, number))
+    finally:
+        settings.storage_class = original_storage_class
+    return results
+
+
+def format_bench_result(result):
+    lines = [
+        f"{result['storage_class']}: {result['updates_per_sec']} updates/sec, "
+        f"p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+        f"memory growth {result['memory_growth_mb']} MB",
+        format_summary(result),
+    ]
+    return '\n'.join(lines)
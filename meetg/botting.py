@@ -1,18 +1,28 @@
-import datetime, time
+import datetime, threading, time
 from collections import defaultdict
 
 import pytz, telegram
 from telegram.ext import Handler, Updater
 
 import settings
-from meetg.api_methods import api_methods
+from meetg.api_methods import api_methods, ApiCall
+from meetg.broadcasting import Broadcast
+from meetg.caching import ApiResponseCache
+from meetg.cleaning import Cleanup
+from meetg.delivering import DeliverabilityIndex
+from meetg.exporting import MetricsServer
 from meetg.loging import get_logger
-from meetg.stats import DateCache, get_reports, _SaveTimeJobQueueWrapper, service_cache
+from meetg.migrating import ChatMigrationRegistry
+from meetg.routing import HandlerRouter, RoutingHandler
+from meetg.scheduling import delay_queue
+from meetg.sending import Outbox
+from meetg.stats import MinuteCounter, get_reports, _SaveTimeJobQueueWrapper, service_cache
 from meetg.storage import db
 from meetg.testing import UpdaterMock
+from meetg.throttling import RateLimiter
 from meetg.factories import MessageUpdateFactory
 from meetg.utils import (
-    get_current_unixtime, get_unixtime_before_now, get_update_type, import_string,
+    BoundedSet, get_current_unixtime, get_unixtime_before_now, get_update_type, import_string,
 )
 
 
@@ -25,25 +35,126 @@ class BaseBot:
     def __init__(self):
         db.init_models()
         self._is_mock = settings.is_test
+        self.last_method = None
         self._init_updater()
+        self._init_api_methods()
+        self._init_username()
         self._init_handlers()
         self._init_jobs()
-        self.last_method = None
         self.last_update = None
+        self.last_handler = None
 
     def _init_updater(self):
         """Init PTB updater"""
         updater_class = UpdaterMock if self._is_mock else Updater
-        self.updater = updater_class(settings.tg_api_token, use_context=True)
+        kwargs = {}
+        if settings.tg_api_base_url:
+            kwargs['base_url'] = settings.tg_api_base_url
+            kwargs['base_file_url'] = settings.tg_api_base_file_url
+        self.updater = updater_class(
+            settings.tg_api_token, use_context=True, workers=settings.updater_workers,
+            request_kwargs=self._get_request_kwargs(), **kwargs,
+        )
         self._tgbot = self.updater.bot
-        self.username = self.updater.bot.get_me().username
+
+    def _get_request_kwargs(self):
+        """
+        Params of the HTTP connection pool. If its size isn't set, there is
+        a connection for each thread that may call the API at the same time
+        """
+        con_pool_size = settings.con_pool_size
+        if not con_pool_size:
+            outbox_workers = settings.outbox_workers if settings.outbox_methods else 0
+            # pools of merged messages and debounced edits
+            deferring = (
+                bool(settings.coalesce_messages_window) + bool(settings.edit_debounce_interval)
+            )
+            con_pool_size = (
+                settings.updater_workers + settings.broadcast_workers
+                + settings.delay_queue_workers + settings.cleanup_workers + outbox_workers
+                + settings.deferred_send_workers * deferring
+                + 4  # 4 more for the updater and job queue
+            )
+        request_kwargs = {
+            'con_pool_size': con_pool_size,
+            'connect_timeout': settings.connect_timeout,
+            'read_timeout': settings.read_timeout,
+        }
+        if settings.proxy_url:
+            request_kwargs['proxy_url'] = settings.proxy_url
+            request_kwargs['urllib3_proxy_kwargs'] = settings.proxy_kwargs
+        return request_kwargs
+
+    def _init_api_methods(self):
+        """
+        Resolve API methods once, so calling them doesn't involve
+        __getattr__ and creation of new objects each time
+        """
+        # Telegram limits aren't applicable to mocked API methods
+        self._rate_limiter = None if self._is_mock else RateLimiter.from_settings()
+        self._deliverability = DeliverabilityIndex()
+        self._migrations = ChatMigrationRegistry()
+        self._api_cache = ApiResponseCache()
+        self._api_methods = {}
+        for name, method_cls in api_methods.items():
+            method = method_cls(self._tgbot, self._rate_limiter)
+            method.deliverability = self._deliverability
+            method.migrations = self._migrations
+            method.cache = self._api_cache
+            self._api_methods[name] = method
+            if not hasattr(type(self), name):
+                setattr(self, name, self._bind_api_method(method))
+        # lone items of media groups are sent by single media methods
+        self._api_methods['send_media_group'].methods = self._api_methods
+        self._api_methods['send_media_group'].new_api_call = self._new_api_call
+
+        self._outbox = None
+        if settings.outbox_methods:
+            self._outbox = Outbox(self._api_methods)
+            for name in settings.outbox_methods:
+                self._api_methods[name].outbox = self._outbox
+
+    def _init_username(self):
+        """The bot info is got by the cached get_me, not on each start"""
+        if self._is_mock:
+            self.username = self._tgbot.get_me().username
+            return
+        success, me = self.get_me()
+        if not success:
+            me = self._tgbot.get_me()
+        # PTB requests the info by itself if it's not set
+        self._tgbot._bot = me
+        self.username = me.username
+
+    def _bind_api_method(self, method):
+        """
+        Return a function calling the method's easy_call() or call().
+        Only in tests the call is remembered in self.last_method
+        """
+        def api_method(*args, raise_exception=None, easy=True, **kwargs):
+            record = self._new_api_call(method, raise_exception)
+            if easy:
+                return method.easy_call(record, *args, **kwargs)
+            else:
+                return method.call(record, **kwargs)
+
+        api_method.__name__ = method.name
+        api_method.__doc__ = method.easy_call.__doc__
+        return api_method
+
+    def _new_api_call(self, method, raise_exception=None):
+        record = ApiCall(method, raise_exception)
+        if self._is_mock:
+            self.last_method = record
+        return record
 
     def _init_handlers(self):
         service_handler = _ServiceHandler(self)
+        self._service_handler = service_handler
         self._handlers = (service_handler,) + self.init_handlers()
+        self._router = HandlerRouter(self._handlers)
         if not self._is_mock:
-            for handler in self._handlers:
-                self.updater.dispatcher.add_handler(handler)
+            self.updater.dispatcher.add_handler(RoutingHandler(self._router))
 
     def init_handlers(self):
         """Intended to be redefined in your bot class"""
@@ -63,10 +174,10 @@ class BaseBot:
 
     def _simulate_process_update(self, update):
         """Simulation of telegram.ext.dispatcher.Dispatcher.process_update()"""
-        for handler in self._handlers:
-            check = handler.check_update(update)
-            if check not in (None, False):
-                return handler.callback(update, None)
+        handler, check = self._router.route(update)
+        self.last_handler = handler
+        if handler is not None:
+            return handler.callback(update, None)
 
     def _job_report_stats(self, context=None):
         """Report bots stats daily"""
@@ -79,19 +190,45 @@ class BaseBot:
             self.send_messages(settings.report_to, stats)
 
     def run(self):
+        if settings.store_update_offset:
+            self.updater.last_update_id = db.State.get('update_offset', 0)
+        if self._outbox:
+            self._outbox.start()
+        if settings.metrics_port is not None:
+            MetricsServer(self, settings.metrics_host, settings.metrics_port).start()
         self.updater.start_polling()
         logger.info('@%s started', self.username)
         self.updater.idle()
+        self._service_handler.flush_offset()
 
-    def send_messages(self, chat_ids, text, reply_to=None, markup=None, html=None, preview=False):
-        """Shortcut to replace multiple send_message API calls"""
-        for chat_id in chat_ids:
-            self.send_message(
-                chat_id, text, reply_to=reply_to, markup=markup, html=html, preview=preview,
-            )
+    def send_messages(
+            self, chat_ids, text, reply_to=None, markup=None, html=None, preview=False,
+            broadcast_id=None,
+        ):
+        """
+        Shortcut to replace multiple send_message API calls.
+        Chats known as undeliverable are skipped. Return counts of
+        sent, failed, blocked, migrated and skipped messages
+        """
+        broadcast = Broadcast(
+            self, chat_ids, text, broadcast_id=broadcast_id,
+            reply_to=reply_to, markup=markup, html=html, preview=preview,
+        )
+        results = broadcast.run()
         logger.info(
             'Message with text length %s broadcasted to %s chats', len(text), len(chat_ids),
         )
+        return results
+
+    def delete_messages(self, messages=(), model=None, query=None, **kwargs):
+        """
+        Shortcut to replace multiple delete_message API calls, by (chat_id, message_id)
+        pairs or objects of the model found by the query. Return counts of deleted,
+        missing, failed and skipped messages. To run it as a job, schedule
+        Cleanup(...).run_job
+        """
+        cleanup = Cleanup(self, messages, model=model, query=query, **kwargs)
+        return cleanup.run()
 
     def receive_message(self, text='', **kwargs):
         """
@@ -110,52 +247,100 @@ class BaseBot:
         return self._simulate_process_update(update)
 
     def __getattr__(self, attrname):
-        """
-        Find API method class by the name, instantiate it,
-        remember in self.last_method and return generated method
-        with its easy_call() result inside
-        """
-        method_cls = api_methods.get(attrname)
-        if method_cls:
-
-            def _internal_call(*args, **kwargs):
-                raise_exception = kwargs.pop('raise_exception', None)
-                method_obj = method_cls(self._tgbot, raise_exception)
-                self.last_method = method_obj
-
-                if kwargs.pop('easy', True):
-                    return method_obj.easy_call(*args, **kwargs)
-                else:
-                    return method_obj.call(*args, **kwargs)
-
-            return _internal_call
-
-        else:
-            raise NameError(f'API method {attrname} not found')
+        """API methods are set in _init_api_methods(), so any other name is unknown"""
+        raise NameError(f'API method {attrname} not found')
 
 
 class _ServiceHandler(Handler):
     """
-    Fake handler which handles no updates,
+    Fake handler which handles only duplicated updates, to drop them,
     but saves info from each Update for update-related models,
     if they are enabled, and count stats
     """
     def __init__(self, bot):
-        super().__init__(lambda: None)
+        super().__init__(self.drop)
         self.bot = bot
+        self._seen_update_ids = BoundedSet(settings.seen_updates_size)
+        self._update_offset = 0
+        self._saved_offset = 0
+        self._offset_flush_scheduled = False
+        self._offset_lock = threading.Lock()
 
     def check_update(self, update):
         """The method triggers by PTB on each received update"""
+        if update.update_id in self._seen_update_ids:
+            logger.warning('Update %s is already processed, dropping it', update.update_id)
+            return True
+        self._seen_update_ids.add(update.update_id)
+
         self.bot.last_update = update
         self.save(update)
         self.count(update)
+        self.save_offset(update)
+        self.clear_undeliverable(update)
+        self.register_migration(update)
+        self.invalidate_cache(update)
+
+    def drop(self, update, context):
+        """Callback for duplicated updates, so no other handler receives them"""
+        pass
+
+    def save_offset(self, update):
+        """
+        Remember the offset, it's persisted in background once per interval,
+        not to make a storage call on each update in the dispatcher thread
+        """
+        offset = update.update_id + 1
+        if settings.store_update_offset and offset > self._update_offset:
+            self._update_offset = offset
+            interval = settings.update_offset_save_interval
+            if not interval:
+                self.flush_offset()
+            elif not self._offset_flush_scheduled:
+                self._offset_flush_scheduled = True
+                delay_queue.schedule(interval, self.flush_offset)
+
+    def flush_offset(self):
+        """Persist the offset to request updates from after a restart"""
+        with self._offset_lock:
+            self._offset_flush_scheduled = False
+            offset = self._update_offset
+            if offset > self._saved_offset:
+                db.State.set('update_offset', offset)
+                self._saved_offset = offset
+
+    def clear_undeliverable(self, update):
+        """A chat which sent an update is deliverable again, unless the bot has just left it"""
+        chat_member = update.my_chat_member
+        if chat_member and chat_member.new_chat_member.status in ('kicked', 'left'):
+            return
+        if update.effective_chat:
+            self.bot._deliverability.clear(update.effective_chat.id)
+
+    def register_migration(self, update):
+        """Service messages about group migration come to both the group and the supergroup"""
+        message = update.effective_message
+        if message and message.migrate_to_chat_id:
+            self.bot._migrations.register(message.chat.id, message.migrate_to_chat_id)
+        elif message and message.migrate_from_chat_id:
+            self.bot._migrations.register(message.migrate_from_chat_id, message.chat.id)
+
+    def invalidate_cache(self, update):
+        """Forget cached info about the chat if the update says it has changed"""
+        message = update.effective_message
+        changed = update.chat_member or update.my_chat_member or message and (
+            message.new_chat_title or message.new_chat_photo or message.delete_chat_photo
+            or message.new_chat_members or message.left_chat_member or message.pinned_message
+        )
+        if changed and update.effective_chat:
+            self.bot._api_cache.invalidate(update.effective_chat.id)
 
     def count(self, update):
         """Count stats for a later report"""
         update_type = get_update_type(update)
         if update_type == 'message':
             update_type = f'{update.effective_chat.type} {update_type}'
-        service_cache['stats']['update'].init(DateCache)
+        service_cache['stats']['update'].init(MinuteCounter)
         service_cache['stats']['update'][update_type].add()
 
     def save(self, update):
@@ -0,0 +1,156 @@
+"""
+Sending the same message to many chats
+"""
+import hashlib, time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import telegram
+
+import settings
+from meetg.loging import get_logger
+from meetg.storage import db
+
+
+logger = get_logger()
+
+RESULT_KEYS = ('sent', 'failed', 'blocked', 'migrated', 'skipped')
+
+
+def get_broadcast_id(chat_ids, text):
+    """Same message to the same chats gets the same id, so it can be resumed"""
+    content = repr((tuple(chat_ids), text)).encode()
+    return hashlib.sha1(content).hexdigest()
+
+
+class Broadcast:
+    """
+    Sends a message to the chats over a pool of worker threads,
+    within rate limits of the API methods. The progress is checkpointed
+    in storage, so the broadcast interrupted by a crash is resumed
+    when it's started again with the same message and chats
+    """
+    method_name = 'send_message'
+
+    def __init__(self, bot, chat_ids, text, broadcast_id=None, **kwargs):
+        self.bot = bot
+        self.chat_ids = list(chat_ids)
+        self.text = text
+        self.kwargs = kwargs
+        self.broadcast_id = broadcast_id or get_broadcast_id(self.chat_ids, text)
+        self.method = bot._api_methods[self.method_name]
+
+        self.results = dict.fromkeys(RESULT_KEYS, 0)
+        self.position = 0
+        # results of chats before the position, only they are checkpointed,
+        # as chats after it are sent again when the broadcast is resumed
+        self._checkpoint_results = dict.fromkeys(RESULT_KEYS, 0)
+        # results of chats done out of order, after the position
+        self._done_positions = {}
+        self._since_checkpoint = 0
+        self._started_at = None
+        self._logged_at = None
+
+    def _load_checkpoint(self):
+        checkpoint = db.Broadcast.find_one({'broadcast_id': self.broadcast_id})
+        if checkpoint and not checkpoint['finished']:
+            self.position = checkpoint['position']
+            self.results.update(checkpoint['results'])
+            self._checkpoint_results.update(checkpoint['results'])
+            logger.info(
+                'Resuming broadcast %s from chat %s of %s',
+                self.broadcast_id, self.position, len(self.chat_ids),
+            )
+        elif checkpoint:
+            db.Broadcast.update_one(
+                {'broadcast_id': self.broadcast_id},
+                {'position': 0, 'results': self.results, 'finished': False},
+            )
+        else:
+            db.Broadcast.create({
+                'broadcast_id': self.broadcast_id, 'total': len(self.chat_ids),
+                'position': 0, 'results': self.results, 'finished': False,
+            })
+
+    def _save_checkpoint(self, finished=False):
+        db.Broadcast.update_one(
+            {'broadcast_id': self.broadcast_id},
+            {
+                'position': self.position, 'results': self._checkpoint_results,
+                'finished': finished,
+            },
+        )
+        self._since_checkpoint = 0
+
+    def _send(self, chat_id):
+        """Send the message to one chat and return the result key"""
+        record = self.bot._new_api_call(self.method)
+        try:
+            result = self.method.easy_call(record, chat_id, self.text, **self.kwargs)
+            if isinstance(result, Future):
+                result = result.result()
+            success, response = result
+        except Exception:
+            logger.exception('Broadcast %s failed to chat %s', self.broadcast_id, chat_id)
+            return 'failed'
+        if success:
+            if record.args['chat_id'] != chat_id:
+                return 'migrated'
+            return 'sent'
+        if isinstance(record.error, telegram.error.Unauthorized):
+            return 'blocked'
+        return 'failed'
+
+    def _complete(self, position, result):
+        self.results[result] += 1
+        self._done_positions[position] = result
+        while self.position in self._done_positions:
+            self._checkpoint_results[self._done_positions.pop(self.position)] += 1
+            self.position += 1
+
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= settings.broadcast_checkpoint_every:
+            self._save_checkpoint()
+        self._log_progress()
+
+    def _log_progress(self, force=False):
+        now = time.monotonic()
+        if force or now - self._logged_at >= settings.broadcast_log_interval:
+            done = sum(self.results.values())
+            elapsed = now - self._started_at
+            rate = done / elapsed if elapsed else 0
+            logger.info(
+                'Broadcast %s: %s of %s chats done, %.1f chats/sec, %s',
+                self.broadcast_id, done, len(self.chat_ids), rate, self.results,
+            )
+            self._logged_at = now
+
+    def run(self):
+        """Send the message to all the chats and return aggregated results"""
+        self._started_at = self._logged_at = time.monotonic()
+        self._load_checkpoint()
+        to_send = self.chat_ids[self.position:]
+        undeliverable = self.bot._deliverability.get_undeliverable(to_send)
+
+        workers = settings.broadcast_workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for position, chat_id in enumerate(to_send, start=self.position):
+                if chat_id in undeliverable:
+                    self._complete(position, 'skipped')
+                    continue
+
+                # keep the number of futures bounded, not one per chat
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._complete(pending.pop(future), future.result())
+
+                future = executor.submit(self._send, chat_id)
+                pending[future] = position
+
+            for future in list(pending):
+                self._complete(pending.pop(future), future.result())
+
+        self._save_checkpoint(finished=True)
+        self._log_progress(force=True)
+        return self.results
@@ -0,0 +1,148 @@
+"""
+Caches of data received from Telegram, to not request or upload it again
+"""
+import hashlib, io, os, threading, time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from pathlib import Path
+
+from meetg.storage import db
+
+
+def read_file_input(file_input):
+    """
+    Return content of a file passed to a media method, and the value to send instead
+    of the passed one. Content is None if the input isn't a file, e.g. it's a file_id or URL
+    """
+    if isinstance(file_input, bytes):
+        return file_input, file_input
+
+    if hasattr(file_input, 'read'):
+        content = file_input.read()
+        if hasattr(file_input, 'seek') and file_input.seekable():
+            file_input.seek(0)
+            return content, file_input
+        return content, content
+
+    if isinstance(file_input, (str, Path)) and os.path.isfile(file_input):
+        with open(file_input, 'rb') as f:
+            content = f.read()
+        to_send = io.BytesIO(content)
+        to_send.name = os.path.basename(file_input)
+        return content, to_send
+
+    return None, file_input
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class FileIdCache:
+    """
+    file_id of uploaded files by the hash of their content,
+    in memory for the most used files and in storage for all of them
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, file_id):
+        with self._lock:
+            self._memory[key] = file_id
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+
+    def get(self, file_type, content_hash):
+        key = (file_type, content_hash)
+        with self._lock:
+            file_id = self._memory.get(key)
+            if file_id is not None:
+                self._memory.move_to_end(key)
+        if file_id is None:
+            db_obj = db.FileId.find_one({'file_type': file_type, 'hash': content_hash})
+            if db_obj:
+                file_id = db_obj['file_id']
+                self._remember(key, file_id)
+        return file_id
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def set(self, file_type, content_hash, file_id):
+        self._remember((file_type, content_hash), file_id)
+        db.FileId.set(file_type, content_hash, file_id)
+
+
+"""App-wide cache of uploaded files"""
+file_id_cache = FileIdCache()
+
+
+class ApiResponseCache:
+    """
+    Successful responses of read-only API methods, kept for their TTL.
+    Concurrent identical calls are made once, others wait for its response
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._chat_keys = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get_or_call(self, key, chat_id, ttl, call):
+        """Return the cached result of the call, or make it and cache the result if it succeeds"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = call()
+        except Exception as exc:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            success, response = result
+            if success:
+                self._set(key, chat_id, time.monotonic() + ttl, result)
+        future.set_result(result)
+        return result
+
+    def _set(self, key, chat_id, expires_at, result):
+        """Call with the lock acquired"""
+        self._entries[key] = (expires_at, result, chat_id)
+        self._entries.move_to_end(key)
+        self._chat_keys[chat_id].add(key)
+        if len(self._entries) > self.size:
+            old_key, (_, _, old_chat_id) = self._entries.popitem(last=False)
+            keys = self._chat_keys[old_chat_id]
+            keys.discard(old_key)
+            if not keys:
+                del self._chat_keys[old_chat_id]
+
+    def invalidate(self, chat_id):
+        """Forget responses about the chat"""
+        with self._lock:
+            for key in self._chat_keys.pop(chat_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chat_keys.clear()
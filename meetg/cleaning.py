@@ -0,0 +1,126 @@
+"""
+Deleting many messages in many chats
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import telegram
+
+import settings
+from meetg.loging import get_logger
+
+
+logger = get_logger()
+
+RESULT_KEYS = ('deleted', 'missing', 'failed', 'skipped')
+
+
+def get_field(obj, dotted_name):
+    """Value of a nested field of a stored object, like 'chat.id'"""
+    for name in dotted_name.split('.'):
+        obj = obj.get(name) if isinstance(obj, dict) else None
+    return obj
+
+
+class Cleanup:
+    """
+    Deletes messages grouped by chats. Chats are cleaned in parallel, messages in a chat
+    one by one, paced by the rate limiter within Telegram limits of the chat. Messages are
+    given as (chat_id, message_id) pairs, or as objects of a model found by a query,
+    which may be a function returning the query, to compute it on each run of a job
+    """
+    method_name = 'delete_message'
+
+    def __init__(
+            self, bot, messages=(), model=None, query=None, chat_id_field='chat.id',
+            message_id_field='message_id', delete_objects=False,
+        ):
+        self.bot = bot
+        self.messages = list(messages)
+        self.model = model
+        self.query = query
+        self.chat_id_field = chat_id_field
+        self.message_id_field = message_id_field
+        # whether to delete the objects of deleted or already missing messages from the model
+        self.delete_objects = delete_objects
+        self.method = bot._api_methods[self.method_name]
+
+    def _get_messages_by_chats(self):
+        """Return message ids by chat ids, and stored object ids by messages"""
+        messages = defaultdict(set)
+        object_ids = {}
+        for chat_id, message_id in self.messages:
+            messages[chat_id].add(message_id)
+
+        if self.model is not None:
+            query = self.query() if callable(self.query) else self.query
+            for obj in self.model.find(query):
+                chat_id = get_field(obj, self.chat_id_field)
+                message_id = get_field(obj, self.message_id_field)
+                if chat_id is not None and message_id is not None:
+                    messages[chat_id].add(message_id)
+                    object_ids[chat_id, message_id] = obj['_id']
+        return messages, object_ids
+
+    def _delete(self, chat_id, message_id):
+        """Delete one message and return the result key"""
+        record = self.bot._new_api_call(self.method)
+        try:
+            result = self.method.call(record, chat_id=chat_id, message_id=message_id)
+            if isinstance(result, Future):
+                result = result.result()
+            success, response = result
+        except Exception:
+            logger.exception('Failed to delete message %s in chat %s', message_id, chat_id)
+            return 'failed'
+        if success:
+            return 'deleted'
+        if isinstance(record.error, telegram.error.BadRequest) and 'not found' in response:
+            return 'missing'
+        return 'failed'
+
+    def _clean_chat(self, chat_id, message_ids):
+        results = dict.fromkeys(RESULT_KEYS, 0)
+        done = []
+        for message_id in sorted(message_ids):
+            result = self._delete(chat_id, message_id)
+            results[result] += 1
+            if result in ('deleted', 'missing'):
+                done.append(message_id)
+        return results, done
+
+    def run(self):
+        """Delete the messages and return counts of deleted, missing, failed and skipped ones"""
+        started_at = time.monotonic()
+        messages, object_ids = self._get_messages_by_chats()
+        results = dict.fromkeys(RESULT_KEYS, 0)
+
+        undeliverable = self.bot._deliverability.get_undeliverable(messages)
+        for chat_id in undeliverable:
+            results['skipped'] += len(messages.pop(chat_id))
+
+        with ThreadPoolExecutor(max_workers=settings.cleanup_workers) as executor:
+            futures = {
+                executor.submit(self._clean_chat, chat_id, message_ids): chat_id
+                for chat_id, message_ids in messages.items()
+            }
+            for future, chat_id in futures.items():
+                chat_results, done = future.result()
+                for key, count in chat_results.items():
+                    results[key] += count
+                if self.delete_objects:
+                    for message_id in done:
+                        object_id = object_ids.get((chat_id, message_id))
+                        if object_id is not None:
+                            self.model.delete_one({'_id': object_id})
+
+        logger.info(
+            'Cleaned up messages in %s chats in %.1f seconds: %s',
+            len(messages), time.monotonic() - started_at, results,
+        )
+        return results
+
+    def run_job(self, context=None):
+        """Callback to schedule the cleanup as a job"""
+        self.run()
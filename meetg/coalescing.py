@@ -0,0 +1,107 @@
+"""
+Merging messages sent to the same chat in quick succession into one
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import settings
+from meetg.loging import get_logger
+from meetg.scheduling import delay_queue
+
+
+logger = get_logger()
+
+MAX_TEXT_LENGTH = 4096
+
+
+class _Batch:
+
+    def __init__(self, record):
+        self.records = [record]
+        self.texts = [record.args['text']]
+        self.length = len(record.args['text'])
+        self.future = Future()
+
+    def get_other_args(self, record):
+        return {key: value for key, value in record.args.items() if key != 'text'}
+
+    def can_merge(self, record):
+        """Only messages with the same parse mode, markup, etc, fitting the length limit"""
+        text = record.args['text']
+        length = self.length + len(settings.coalesce_separator) + len(text)
+        other_args = self.get_other_args(record)
+        return length <= MAX_TEXT_LENGTH and other_args == self.get_other_args(self.records[0])
+
+    def merge(self, record):
+        self.records.append(record)
+        self.texts.append(record.args['text'])
+        self.length += len(settings.coalesce_separator) + len(record.args['text'])
+
+
+class MessageCoalescer:
+    """
+    Holds a message to a chat for the window. Messages to the same chat
+    sent within it are merged into the held one, and all of them get
+    a Future with the result of the merged message. Merged messages are sent
+    by a pool of their own, as retries of the calls may need delay queue workers
+    """
+    def __init__(self, method, window):
+        self.method = method
+        self.window = window
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.deferred_send_workers, thread_name_prefix='meetg_coalesce',
+        )
+
+    def accepts(self, record):
+        text = record.args.get('text')
+        # entity offsets would be broken by merging
+        return bool(text) and len(text) <= MAX_TEXT_LENGTH and not record.args.get('entities')
+
+    def add(self, record):
+        chat_id = record.args.get('chat_id')
+        with self._lock:
+            batch = self._batches.get(chat_id)
+            if batch and batch.can_merge(record):
+                batch.merge(record)
+                return batch.future
+
+            if batch:
+                # send the held one now, to keep the order of messages
+                del self._batches[chat_id]
+                delay_queue.schedule(0, self._flush, chat_id, batch)
+            batch = _Batch(record)
+            self._batches[chat_id] = batch
+        delay_queue.schedule(self.window, self._flush, chat_id, batch)
+        return batch.future
+
+    def _flush(self, chat_id, batch):
+        with self._lock:
+            if self._batches.get(chat_id) is batch:
+                del self._batches[chat_id]
+            elif batch.future.done() or batch.future.running():
+                return
+            # no more merges to the batch since here
+            batch.future.set_running_or_notify_cancel()
+
+        record = batch.records[0]
+        if len(batch.records) > 1:
+            logger.debug('Merged %s messages to chat %s', len(batch.records), chat_id)
+            record.args['text'] = settings.coalesce_separator.join(batch.texts)
+        self._executor.submit(self._send, record, batch)
+
+    def _send(self, record, batch):
+        try:
+            result = self.method.send_now(record)
+            if isinstance(result, Future):
+                result = result.result()
+        except Exception as exc:
+            batch.future.set_exception(exc)
+            return
+
+        for merged in batch.records[1:]:
+            merged.success = record.success
+            merged.response = record.response
+            merged.error = record.error
+        batch.future.set_result(result)
@@ -0,0 +1,92 @@
+"""
+Debouncing repeated edits of the same message
+"""
+import threading, time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import settings
+
+from meetg.loging import get_logger
+from meetg.scheduling import delay_queue
+
+
+logger = get_logger()
+
+
+class EditDebouncer:
+    """
+    Edits the same message at most once per interval. Pending edits are replaced
+    by newer ones, only the latest is sent, and all of them get a Future with its result.
+    Edits to the text that was sent last are skipped. Edits are sent by a pool
+    of their own, as retries of the calls may need delay queue workers
+    """
+    def __init__(self, method, interval, size=10000):
+        self.method = method
+        self.interval = interval
+        self.size = size
+        self._pending = {}
+        self._last_sent = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.deferred_send_workers, thread_name_prefix='meetg_debounce',
+        )
+
+    def get_key(self, record):
+        args = record.args
+        return args.get('chat_id'), args.get('message_id'), args.get('inline_message_id')
+
+    def get_content(self, record):
+        args = record.args
+        return args.get('text'), args.get('parse_mode'), args.get('reply_markup')
+
+    def add(self, record):
+        key = self.get_key(record)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending:
+                # the previous pending edit is replaced, it's outdated anyway
+                pending[0] = record
+                return pending[1]
+
+            future = Future()
+            self._pending[key] = [record, future]
+            last_sent_at = self._last_sent[key][1] if key in self._last_sent else None
+        delay = 0 if last_sent_at is None else last_sent_at + self.interval - time.monotonic()
+        delay_queue.schedule(delay, self._flush, key)
+        return future
+
+    def _set_last_sent(self, key, content):
+        """Call with the lock acquired"""
+        self._last_sent[key] = (content, time.monotonic())
+        self._last_sent.move_to_end(key)
+        if len(self._last_sent) > self.size:
+            self._last_sent.popitem(last=False)
+
+    def _flush(self, key):
+        with self._lock:
+            record, future = self._pending.pop(key)
+            last_content = self._last_sent[key][0] if key in self._last_sent else None
+            # edits added while this one is sent wait for the interval since now
+            self._set_last_sent(key, last_content)
+
+        content = self.get_content(record)
+        if content == last_content:
+            logger.debug('Skipped edit of message %s, nothing changed', key)
+            record.success = True
+            future.set_result((True, None))
+            return
+        self._executor.submit(self._send, key, record, future, content)
+
+    def _send(self, key, record, future, content):
+        try:
+            result = self.method.send_now(record)
+            if isinstance(result, Future):
+                result = result.result()
+        except Exception as exc:
+            future.set_exception(exc)
+            return
+        if record.success:
+            with self._lock:
+                self._set_last_sent(key, content)
+        future.set_result(result)
@@ -2,6 +2,9 @@ import logging
 
 
 tg_api_token = ''
+# Bot API server other than Telegram, e.g. a local one or MockBotApiServer.base_url for load tests
+tg_api_base_url = None
+tg_api_base_file_url = None
 
 db_name = ''
 db_name_test = ''
@@ -14,13 +17,110 @@ Update_model = 'meetg.storage.DefaultUpdateModel'
 Message_model = 'meetg.storage.DefaultMessageModel'
 User_model = 'meetg.storage.DefaultUserModel'
 Chat_model = 'meetg.storage.DefaultChatModel'
+State_model = 'meetg.storage.DefaultStateModel'
+Broadcast_model = 'meetg.storage.DefaultBroadcastModel'
+FileId_model = 'meetg.storage.DefaultFileIdModel'
+Outbox_model = 'meetg.storage.DefaultOutboxModel'
+ChatMigration_model = 'meetg.storage.DefaultChatMigrationModel'
 
 store_api_types = True
 
+# Remember file_id of uploaded media, to send it instead of the same content next time
+cache_file_ids = True
+
+# Resize, recompress and strip metadata of photos, and make thumbnails of image documents,
+# in a pool of processes before uploading them
+process_images = False
+image_max_side = 2560
+image_quality = 85
+# None means the number of CPUs
+image_workers = None
+
+# Persist the last processed update offset, to continue from it after a restart
+store_update_offset = True
+# The offset is persisted once per this number of seconds, and when the bot is stopped.
+# After a crash, updates of the last interval may be processed again. 0 persists it on each update
+update_offset_save_interval = 5
+# How many last update ids to remember to drop duplicated updates
+seen_updates_size = 10000
+
+# Storage classes compared by "manage.py bench". If empty, only storage_class is used
+bench_storage_classes = ()
+
 bot_class = 'meetg.botting.BaseBot'
 
+# Threads of PTB dispatcher running handlers with run_async=True
+updater_workers = 4
+
+# Size of the HTTP connection pool to Telegram. If None, it's calculated by numbers of workers.
+# Connections are kept alive by PTB, with TCP keepalive probes
+con_pool_size = None
+connect_timeout = 5.0
+read_timeout = 5.0
+# e.g. 'socks5://host:1080', and urllib3 proxy params, like {'username': ..., 'password': ...}
+proxy_url = None
+proxy_kwargs = None
+
 api_attempts = 5
+# Wait after a network error doubles with each attempt, up to the max wait
 network_error_wait = 2
+network_error_max_wait = 60
+network_error_jitter = True
+# "sleep" waits between attempts in the calling thread. "schedule" makes the calling thread free
+# by retrying failed calls in the delay queue, and such calls return a Future with the result
+api_retry_mode = 'sleep'
+delay_queue_workers = 4
+
+# After this number of consecutive failures of Telegram, calls of the method fail fast
+# for circuit_breaker_timeout seconds, then one probe call is let through. None disables it
+circuit_breaker_threshold = 5
+circuit_breaker_timeout = 30
+
+# Outgoing rate limits as (calls, seconds). None disables the limit
+rate_limit_global = (30, 1)
+rate_limit_private_chat = (1, 1)
+rate_limit_group_chat = (20, 60)
+
+# Seconds to cache successful responses of read-only API methods for. The bot info
+# from get_me is also kept in storage for its TTL, to not request it on each start
+api_cache_ttl = {
+    'get_me': 24 * 60 * 60,
+    'get_chat': 5 * 60,
+    'get_chat_member': 60,
+    'get_chat_administrators': 5 * 60,
+}
+
+# Merge messages sent to the same chat within this number of seconds into one message.
+# Such calls of send_message return a Future. 0 disables merging
+coalesce_messages_window = 0
+coalesce_separator = '\n\n'
+
+# Edit the same message at most once per this number of seconds, sending only the latest text
+# and skipping edits not changing it. Such calls of edit_message_text return a Future.
+# 0 disables debouncing
+edit_debounce_interval = 0
+# Threads sending merged messages, and the same number sending debounced edits
+deferred_send_workers = 4
+
+# Names of API methods, e.g. ('send_message',), whose calls are saved to storage
+# and sent by outbox_workers threads in background. Such calls return a Future
+outbox_methods = ()
+outbox_workers = 4
+
+# Port of the HTTP endpoint /metrics with stats in OpenMetrics format, for Prometheus.
+# None disables it
+metrics_port = None
+metrics_host = '127.0.0.1'
+
+# Number of chats where messages are deleted in parallel by BaseBot.delete_messages()
+cleanup_workers = 4
+
+# Number of threads sending a broadcast
+broadcast_workers = 8
+# Save broadcast progress to storage after this number of chats
+broadcast_checkpoint_every = 100
+# Log broadcast progress each this number of seconds
+broadcast_log_interval = 10
 
 log_path = 'log.txt'
 log_level = logging.INFO
@@ -0,0 +1,88 @@
+"""
+Tracking chats messages can't be delivered to
+"""
+import threading
+
+import telegram
+
+from meetg.loging import get_logger
+from meetg.storage import db
+from meetg.utils import get_current_unixtime
+
+
+logger = get_logger()
+
+KICKED = 'kicked'
+BLOCKED = 'blocked'
+DEACTIVATED = 'deactivated'
+NOT_FOUND = 'not found'
+
+# parts of Telegram error messages meaning the chat is dead
+error_states = (
+    ('bot was kicked', KICKED),
+    ('bot was blocked', BLOCKED),
+    ('user is deactivated', DEACTIVATED),
+    ('chat not found', NOT_FOUND),
+)
+
+
+def get_undeliverable_state(error):
+    """Return the state if the error means messages can't be delivered to the chat, else None"""
+    if isinstance(error, (telegram.error.Unauthorized, telegram.error.BadRequest)):
+        message = error.message.lower()
+        for part, state in error_states:
+            if part in message:
+                return state
+
+
+class DeliverabilityIndex:
+    """
+    Undeliverable chats, in storage and in memory, so send methods
+    check them without storage queries. It's loaded from storage on
+    the first check, and a chat is removed when an update comes from it
+    """
+    def __init__(self):
+        self._states = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._states is None:
+            with self._lock:
+                if self._states is None:
+                    query = {'$or': [
+                        {'_undeliverable': {'$ne': None}}, {'_kicked_at': {'$ne': None}},
+                    ]}
+                    self._states = {
+                        chat['id']: chat.get('_undeliverable') or KICKED
+                        for chat in db.Chat.find(query)
+                    }
+                    logger.info('%s undeliverable chats loaded', len(self._states))
+
+    def get(self, chat_id):
+        """Return the state of the chat if it's undeliverable, else None"""
+        self._ensure_loaded()
+        return self._states.get(chat_id)
+
+    def get_undeliverable(self, chat_ids):
+        self._ensure_loaded()
+        return {chat_id for chat_id in chat_ids if chat_id in self._states}
+
+    def mark(self, chat_id, state):
+        self._ensure_loaded()
+        self._states[chat_id] = state
+        logger.info('Chat %s is marked undeliverable: %s', chat_id, state)
+        now = get_current_unixtime()
+        data = {'_undeliverable': state, '_undeliverable_at': now}
+        if state == KICKED:
+            data['_kicked_at'] = now
+        # the chat may be not stored yet, e.g. it's blocked before any update from it,
+        # but a chat not found may be just a wrong id, not worth storing
+        db.Chat.update_one({'id': chat_id}, data, upsert=state != NOT_FOUND)
+
+    def clear(self, chat_id):
+        """Mark the chat deliverable again, if it was not"""
+        self._ensure_loaded()
+        if self._states.pop(chat_id, None) is not None:
+            logger.info('Chat %s is deliverable again', chat_id)
+            data = {'_undeliverable': None, '_undeliverable_at': None, '_kicked_at': None}
+            db.Chat.update_one({'id': chat_id}, data)
@@ -0,0 +1,250 @@
+"""
+Local stand-in for the Telegram Bot API server, to load test the real HTTP path offline
+"""
+import email.parser, json, random, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from meetg.loging import get_logger
+
+
+logger = get_logger()
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Mock', 'username': 'mock_username'}
+
+# error kinds which can be injected, with the HTTP status and description of each
+errors = {
+    'retry_after': (429, 'Too Many Requests: retry after {retry_after}'),
+    'server_error': (502, 'Bad Gateway'),
+    'migrate': (400, 'Bad Request: group chat was upgraded to a supergroup chat'),
+}
+
+# methods sending a message, and the field of the message with the sent file
+send_methods = {
+    'sendMessage': None, 'sendPhoto': 'photo', 'sendDocument': 'document',
+    'sendAnimation': 'animation', 'sendAudio': 'audio', 'sendVideo': 'video',
+    'sendSticker': 'sticker', 'sendContact': None, 'sendLocation': None, 'forwardMessage': None,
+}
+
+
+def parse_multipart(content_type, body):
+    """Return form fields of a multipart body, file fields as bytes"""
+    head = f'Content-Type: {content_type}\r\n\r\n'.encode()
+    message = email.parser.BytesParser().parsebytes(head + body)
+    fields = {}
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True)
+        fields[name] = payload if part.get_filename() else payload.decode()
+    return fields
+
+
+# required fields of sent files besides file_id
+file_fields = {
+    'photo': {'width': 100, 'height': 100},
+    'video': {'width': 100, 'height': 100, 'duration': 1},
+    'animation': {'width': 100, 'height': 100, 'duration': 1},
+    'audio': {'duration': 1},
+    'sticker': {'width': 512, 'height': 512, 'is_animated': False},
+    'document': {},
+}
+
+
+def get_file(file_type, file_input):
+    """Sent file object in the shape Telegram returns, photo as the list of sizes"""
+    if isinstance(file_input, str) and not file_input.startswith('attach://'):
+        file_id = file_input
+    else:
+        file_id = f'file_{random.getrandbits(32)}'
+    sent = dict(file_fields[file_type], file_id=file_id, file_unique_id=file_id[-8:])
+    return [sent] if file_type == 'photo' else sent
+
+
+class MockBotApiServer:
+    """
+    HTTP server answering Bot API methods like Telegram does, with optional latency
+    and error injection. Point a bot to it by settings.tg_api_base_url = server.base_url
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rates=None, retry_after=1):
+        self.latency = latency
+        # probabilities of error kinds for each call sending or editing a message
+        self.error_rates = error_rates or {}
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self._updates = []
+        self._last_update_id = 0
+        self._last_message_id = 0
+        self._condition = threading.Condition()
+        self._http = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._http.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._http.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self._http.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info('Mock Bot API server is listening at %s', self.base_url)
+
+    def serve_forever(self):
+        logger.info('Mock Bot API server is listening at %s', self.base_url)
+        self._http.serve_forever()
+
+    def stop(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+    def add_update(self, update):
+        """Add an update dict for getUpdates, its update_id is set here"""
+        with self._condition:
+            self._last_update_id += 1
+            update['update_id'] = self._last_update_id
+            self._updates.append(update)
+            self._condition.notify_all()
+
+    def generate_updates(self, number):
+        """Add a number of synthetic updates of various kinds"""
+        from meetg.benchmarking import generate_updates
+        from meetg.testing import TgBotMock
+
+        for update in generate_updates(TgBotMock(), number):
+            self.add_update(update.to_dict())
+
+    def feed_updates(self, per_second, stop_event=None):
+        """Add synthetic updates at the rate, until the event is set"""
+        while not (stop_event and stop_event.is_set()):
+            self.generate_updates(1)
+            time.sleep(1 / per_second)
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keeps connections alive, as Telegram does, every response has Content-Length
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                server._handle(self, body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def _parse_params(self, handler, body):
+        content_type = handler.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            params = parse_multipart(content_type, body)
+        elif body:
+            params = json.loads(body)
+        else:
+            params = {}
+        for key in ('chat_id', 'from_chat_id', 'message_id', 'offset', 'timeout', 'limit'):
+            value = params.get(key)
+            if isinstance(value, str) and value.lstrip('-').isdigit():
+                params[key] = int(value)
+        return params
+
+    def _respond(self, handler, status, data):
+        content = json.dumps(data).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def _handle(self, handler, body):
+        token, method = handler.path.rstrip('/').rsplit('/', 2)[-2:]
+        params = self._parse_params(handler, body)
+        self.calls[method] += 1
+
+        if method == 'getUpdates':
+            self._respond(handler, 200, {'ok': True, 'result': self._get_updates(params)})
+            return
+
+        if self.latency:
+            time.sleep(self.latency)
+        error = self._get_error(method, params)
+        if error:
+            self._respond(handler, error['error_code'], error)
+        else:
+            result = self._get_result(method, params)
+            if method == 'getMe':
+                # the bot is the one of the token, as Telegram answers
+                bot_id = token[len('bot'):].split(':')[0]
+                if bot_id.isdigit():
+                    result = dict(result, id=int(bot_id))
+            self._respond(handler, 200, {'ok': True, 'result': result})
+
+    def _get_error(self, method, params):
+        if method not in send_methods and method not in ('editMessageText', 'sendMediaGroup'):
+            return None
+        for kind, rate in self.error_rates.items():
+            if random.random() < rate:
+                status, description = errors[kind]
+                error = {
+                    'ok': False, 'error_code': status,
+                    'description': description.format(retry_after=self.retry_after),
+                }
+                if kind == 'retry_after':
+                    error['parameters'] = {'retry_after': self.retry_after}
+                elif kind == 'migrate':
+                    new_chat_id = -1000000000000 - abs(params.get('chat_id') or 0)
+                    error['parameters'] = {'migrate_to_chat_id': new_chat_id}
+                return error
+
+    def _get_updates(self, params):
+        offset = params.get('offset') or 0
+        limit = params.get('limit') or 100
+        deadline = time.monotonic() + (params.get('timeout') or 0)
+        with self._condition:
+            # updates before the offset are confirmed
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _get_message(self, params, **fields):
+        with self._condition:
+            self._last_message_id += 1
+            message_id = self._last_message_id
+        chat_id = params.get('chat_id')
+        chat_type = 'private' if isinstance(chat_id, int) and chat_id > 0 else 'supergroup'
+        message = {
+            'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+            'chat': {'id': chat_id, 'type': chat_type},
+        }
+        message.update(fields)
+        return message
+
+    def _get_result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self._get_message(params, text=params.get('text'))
+        if method == 'editMessageText':
+            message = self._get_message(params, text=params.get('text'))
+            message['message_id'] = params.get('message_id')
+            return message
+        if send_methods.get(method):
+            field = send_methods[method]
+            return self._get_message(params, **{field: get_file(field, params.get(field))})
+        if method in send_methods:
+            return self._get_message(params)
+        if method == 'sendMediaGroup':
+            media = params.get('media')
+            media = json.loads(media) if isinstance(media, str) else media
+            return [
+                self._get_message(params, **{item['type']: get_file(item['type'], item['media'])})
+                for item in media
+            ]
+        # deleteWebhook, deleteMessage, etc
+        return True
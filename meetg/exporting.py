@@ -0,0 +1,225 @@
+"""
+Exposing runtime stats over HTTP in OpenMetrics text format, for Prometheus to scrape
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+from meetg.loging import get_logger
+from meetg.scheduling import delay_queue
+from meetg.stats import Histogram, service_cache
+
+
+logger = get_logger()
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items())
+    return f'{{{pairs}}}'
+
+
+class MetricsWriter:
+    """Lines of metric families, each family is declared once before its samples"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, help_text, unit=None):
+        self.lines.append(f'# TYPE {name} {metric_type}')
+        if unit:
+            self.lines.append(f'# UNIT {name} {unit}')
+        self.lines.append(f'# HELP {name} {help_text}')
+
+    def sample(self, name, value, **labels):
+        self.lines.append(f'{name}{format_labels(labels)} {value}')
+
+    def histogram(self, name, histogram, **labels):
+        """
+        Cumulative buckets of the histogram, with its count and sum. The count is summed
+        from the buckets, as a copy made without the lock may have them apart
+        """
+        cumulative = 0
+        for bound, count in zip(Histogram.bounds, histogram.counts):
+            cumulative += count
+            self.sample(f'{name}_bucket', cumulative, **labels, le=f'{bound:.6g}')
+        total_count = sum(histogram.counts)
+        self.sample(f'{name}_bucket', total_count, **labels, le='+Inf')
+        self.sample(f'{name}_count', total_count, **labels)
+        self.sample(f'{name}_sum', histogram.total, **labels)
+
+    def get_text(self):
+        return '\n'.join(self.lines + ['# EOF']) + '\n'
+
+
+def _write_updates(writer):
+    counters = list(service_cache['stats']['update'].items())
+    writer.family('meetg_updates', 'counter', 'Received updates by type')
+    for update_type, counter in counters:
+        writer.sample('meetg_updates_total', counter.total, type=update_type)
+
+
+def _write_api(writer):
+    stats = list(service_cache['stats']['api'].items())
+    snapshots = [(name, method_stats.peek()) for name, method_stats in stats]
+    for counter in ('calls', 'successes', 'failures', 'retries'):
+        writer.family(f'meetg_api_{counter}', 'counter', f'API method {counter}')
+        for name, snapshot in snapshots:
+            writer.sample(f'meetg_api_{counter}_total', snapshot[counter], method=name)
+    writer.family(
+        'meetg_api_retry_after_seconds', 'counter', 'Seconds waited by RetryAfter errors',
+        unit='seconds',
+    )
+    for name, snapshot in snapshots:
+        writer.sample('meetg_api_retry_after_seconds_total', snapshot['retry_after'], method=name)
+    writer.family(
+        'meetg_api_latency_seconds', 'histogram', 'API call durations with retries',
+        unit='seconds',
+    )
+    for name, snapshot in snapshots:
+        writer.histogram('meetg_api_latency_seconds', snapshot['latency'], method=name)
+
+
+def _write_storage(writer):
+    stats = list(service_cache['stats']['storage'].items())
+    snapshots = [(key, model_stats.peek()) for key, model_stats in stats]
+    writer.family(
+        'meetg_storage_latency_seconds', 'histogram', 'Storage operation durations',
+        unit='seconds',
+    )
+    for (model, operation), snapshot in snapshots:
+        writer.histogram(
+            'meetg_storage_latency_seconds', snapshot['latency'], model=model, operation=operation,
+        )
+
+
+def _write_jobs(writer):
+    stats = list(service_cache['stats']['job'].items())
+    snapshots = [(name, job_stats.peek()) for name, job_stats in stats]
+    writer.family('meetg_job_runs', 'counter', 'Job runs')
+    for name, snapshot in snapshots:
+        writer.sample('meetg_job_runs_total', snapshot['runs'], job=name)
+    writer.family('meetg_job_duration_seconds', 'histogram', 'Job run durations', unit='seconds')
+    for name, snapshot in snapshots:
+        writer.histogram('meetg_job_duration_seconds', snapshot['duration'], job=name)
+    writer.family(
+        'meetg_job_lag_seconds', 'histogram', 'How late job runs started after the planned time',
+        unit='seconds',
+    )
+    for name, snapshot in snapshots:
+        writer.histogram('meetg_job_lag_seconds', snapshot['lag'], job=name)
+
+
+def _write_breakers(writer):
+    breakers = list(service_cache['stats']['breaker'].items())
+    writer.family('meetg_circuit_breaker_open', 'gauge', 'Whether the breaker isn\'t closed')
+    for name, breaker in breakers:
+        is_open = int(breaker.state != breaker.CLOSED)
+        writer.sample('meetg_circuit_breaker_open', is_open, breaker=name)
+    writer.family('meetg_circuit_breaker_trips', 'counter', 'Circuit breaker trips')
+    for name, breaker in breakers:
+        writer.sample('meetg_circuit_breaker_trips_total', breaker.trips, breaker=name)
+
+
+def _write_queues(writer, bot):
+    writer.family('meetg_queue_depth', 'gauge', 'Items waiting in queues')
+    # lengths of the underlying containers are read without locks of the queues
+    writer.sample('meetg_queue_depth', len(delay_queue), queue='delay')
+    if bot is None:
+        return
+    update_queue = getattr(bot.updater, 'update_queue', None)
+    if update_queue is not None and hasattr(update_queue, 'queue'):
+        writer.sample('meetg_queue_depth', len(update_queue.queue), queue='update')
+    if bot._outbox:
+        writer.sample('meetg_queue_depth', bot._outbox.get_depth(), queue='outbox')
+
+
+def _write_sys(writer):
+    process = psutil.Process()
+    cpu_times = process.cpu_times()
+    writer.family('meetg_process_resident_memory_bytes', 'gauge', 'Occupied RAM', unit='bytes')
+    writer.sample('meetg_process_resident_memory_bytes', process.memory_info().rss)
+    writer.family('meetg_process_cpu_seconds', 'counter', 'CPU time', unit='seconds')
+    writer.sample('meetg_process_cpu_seconds_total', cpu_times.user + cpu_times.system)
+    writer.family('meetg_process_threads', 'gauge', 'Threads of the process')
+    writer.sample('meetg_process_threads', process.num_threads())
+    writer.family('meetg_memory_available_bytes', 'gauge', 'Free RAM', unit='bytes')
+    writer.sample('meetg_memory_available_bytes', psutil.virtual_memory().available)
+    writer.family('meetg_disk_free_bytes', 'gauge', 'Free disk space', unit='bytes')
+    writer.sample('meetg_disk_free_bytes', psutil.disk_usage('/').free)
+
+
+def get_metrics(bot=None):
+    """
+    Return all stats in OpenMetrics text format. Stats are read without their locks,
+    so a scrape never waits for handlers and never makes them wait
+    """
+    writer = MetricsWriter()
+    _write_updates(writer)
+    _write_api(writer)
+    _write_storage(writer)
+    _write_jobs(writer)
+    _write_breakers(writer)
+    _write_queues(writer, bot)
+    _write_sys(writer)
+    return writer.get_text()
+
+
+class MetricsServer:
+    """HTTP server of the /metrics endpoint, in a daemon thread apart from the dispatcher"""
+
+    def __init__(self, bot=None, host='127.0.0.1', port=0):
+        self.bot = bot
+        self._http = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._http.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._http.server_address
+        return f'http://{host}:{port}/metrics'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._http.serve_forever, name='meetg_metrics', daemon=True,
+        )
+        self._thread.start()
+        logger.info('Metrics are served at %s', self.url)
+
+    def stop(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0].rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    content = get_metrics(server.bot).encode()
+                except Exception:
+                    logger.exception('Failed to collect metrics')
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
@@ -0,0 +1,124 @@
+"""
+Preparing images for upload in a pool of processes, off the GIL of dispatcher threads
+"""
+import io, threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+import settings
+from meetg.loging import get_logger
+
+
+logger = get_logger()
+
+# Telegram limits
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+PHOTO_MAX_SIDES_SUM = 10000
+THUMB_MAX_SIDE = 320
+THUMB_MAX_SIZE = 200 * 1024
+
+
+def _open_image(content):
+    image = Image.open(io.BytesIO(content))
+    # rotate by EXIF before EXIF is stripped
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        background = Image.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+    return image
+
+
+def _save_jpeg(image, quality, max_size):
+    """Save without metadata, lowering quality until it fits into the max size"""
+    while True:
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+        if output.tell() <= max_size or quality <= 30:
+            return output.getvalue()
+        quality -= 10
+
+
+def process_photo(content, max_side, quality):
+    """Return JPEG content resized to the max side and Telegram limits, without metadata"""
+    image = _open_image(content)
+    width, height = image.size
+    scale = min(1, max_side / max(width, height), PHOTO_MAX_SIDES_SUM / (width + height))
+    if scale < 1:
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    return _save_jpeg(image, quality, PHOTO_MAX_SIZE)
+
+
+def make_thumb(content, quality):
+    """Return JPEG thumbnail fitting Telegram limits for the thumb parameter"""
+    image = _open_image(content)
+    image.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE), Image.LANCZOS)
+    return _save_jpeg(image, quality, THUMB_MAX_SIZE)
+
+
+def is_image(content):
+    try:
+        Image.open(io.BytesIO(content)).verify()
+    except Exception:
+        return False
+    return True
+
+
+class ImagePipeline:
+    """
+    Runs image processing in worker processes. The calling thread waits for the result,
+    but the CPU work doesn't hold the GIL, so other threads keep processing updates
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Start the pool on first use, once even if several threads need it at a time"""
+        executor = self._executor
+        if executor is None:
+            with self._lock:
+                executor = self._executor
+                if executor is None:
+                    executor = ProcessPoolExecutor(
+                        max_workers=self.workers or settings.image_workers,
+                    )
+                    self._executor = executor
+        return executor
+
+    def _run(self, func, *args):
+        return self._get_executor().submit(func, *args).result()
+
+    def process_photo(self, content):
+        """Return processed content, or the original one if it can't be processed"""
+        try:
+            return self._run(
+                process_photo, content, settings.image_max_side, settings.image_quality,
+            )
+        except Exception:
+            logger.exception('Failed to process photo, sending it as is')
+            return content
+
+    def make_thumb(self, content):
+        """Return the thumbnail, or None if the content isn't an image"""
+        if not is_image(content):
+            return None
+        try:
+            return self._run(make_thumb, content, settings.image_quality)
+        except Exception:
+            logger.exception('Failed to make thumbnail')
+            return None
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+"""App-wide pool of image processes"""
+image_pipeline = ImagePipeline()
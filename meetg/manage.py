@@ -1,3 +1,5 @@
+import argparse
+import json
 import os
 import sys
 import unittest
@@ -6,7 +8,7 @@ import settings
 from meetg.utils import import_string
 
 
-KNOWN_ARGS = ('run', 'test')
+KNOWN_ARGS = ('run', 'test', 'replay', 'bench', 'mock_server')
 
 
 def run_bot(bot_path):
@@ -27,11 +29,100 @@ def run_tests(import_pathes, src_path):
     result = unittest.runner.TextTestRunner().run(suite)
 
 
+def parse_speed(value):
+    """Check the --speed value early, not to replay at the max throughput by a typo"""
+    from meetg.benchmarking import get_multiplier
+
+    try:
+        get_multiplier(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected "max", "real" or a positive number: {value}')
+    return value
+
+
+def run_replay(args):
+    """Replay stored updates through the bot, to load test it by the real traffic"""
+    from meetg.benchmarking import format_summary, replay
+
+    parser = argparse.ArgumentParser(prog='manage.py replay')
+    parser.add_argument('--since', type=float, help='Unix time of the first update to replay')
+    parser.add_argument('--until', type=float, help='Unix time to replay updates before')
+    parser.add_argument('--chat', type=int, help='Replay updates only from this chat id')
+    parser.add_argument('--type', help='Replay updates only of this type, e.g. callback_query')
+    parser.add_argument(
+        '--speed', default='max', type=parse_speed,
+        help='"max" for the max throughput, "real" for the real time, or a multiplier of it',
+    )
+    options = parser.parse_args(args)
+
+    summary = replay(
+        since=options.since, until=options.until, chat_id=options.chat,
+        update_type=options.type, speed=options.speed,
+    )
+    print(format_summary(summary))
+
+
+def run_bench(args):
+    """Measure how many updates per second the bot handles"""
+    from meetg.benchmarking import bench, format_bench_result
+
+    parser = argparse.ArgumentParser(prog='manage.py bench')
+    parser.add_argument('--updates', type=int, default=1000, help='Number of synthetic updates')
+    parser.add_argument('--storage', action='append', help='Storage class, may be repeated')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    options = parser.parse_args(args)
+
+    results = bench(options.updates, options.storage)
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('\n\n'.join(format_bench_result(result) for result in results))
+
+
+def run_mock_server(args):
+    """Serve a local stand-in for the Bot API, to load test the bot offline"""
+    import threading
+    from meetg.emulating import MockBotApiServer
+
+    parser = argparse.ArgumentParser(prog='manage.py mock_server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to answer each call')
+    parser.add_argument('--retry-after-rate', type=float, default=0, help='Share of 429 errors')
+    parser.add_argument('--server-error-rate', type=float, default=0, help='Share of 502 errors')
+    parser.add_argument('--migrate-rate', type=float, default=0, help='Share of ChatMigrated')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of 429 errors')
+    parser.add_argument('--updates-per-second', type=float, help='Rate of synthetic updates')
+    options = parser.parse_args(args)
+
+    error_rates = {
+        'retry_after': options.retry_after_rate, 'server_error': options.server_error_rate,
+        'migrate': options.migrate_rate,
+    }
+    server = MockBotApiServer(
+        options.host, options.port, latency=options.latency, error_rates=error_rates,
+        retry_after=options.retry_after,
+    )
+    if options.updates_per_second:
+        feeder = threading.Thread(
+            target=server.feed_updates, args=(options.updates_per_second,), daemon=True,
+        )
+        feeder.start()
+    print(f'Set tg_api_base_url = {server.base_url!r} in settings to use the server')
+    server.serve_forever()
+
+
 def exec_args(argv, src_path):
     if len(argv) > 1 and argv[1] in KNOWN_ARGS:
         if argv[1] == 'run':
             run_bot(settings.bot_class)
         if argv[1] == 'test':
             run_tests(argv[2:], src_path)
+        if argv[1] == 'replay':
+            run_replay(argv[2:])
+        if argv[1] == 'bench':
+            run_bench(argv[2:])
+        if argv[1] == 'mock_server':
+            run_mock_server(argv[2:])
     else:
         print('Available commands:', ', '.join(KNOWN_ARGS))
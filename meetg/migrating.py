@@ -0,0 +1,65 @@
+"""
+Following groups migrated to supergroups
+"""
+import threading
+
+from meetg.loging import get_logger
+from meetg.scheduling import delay_queue
+from meetg.storage import db
+
+
+logger = get_logger()
+
+
+class ChatMigrationRegistry:
+    """
+    Old chat ids of migrated groups mapped to new ones, in storage and in memory,
+    so chat ids are rewritten before calls, not after failed ones. Stored objects
+    of all models are migrated to the new id in background
+    """
+    def __init__(self):
+        self._new_ids = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._new_ids is None:
+            with self._lock:
+                if self._new_ids is None:
+                    # migrations interrupted by a restart are resumed once, by the loading thread
+                    for migration in db.ChatMigration.find({'migrated': False}):
+                        self._schedule(migration['old_chat_id'], migration['new_chat_id'])
+                    self._new_ids = {
+                        migration['old_chat_id']: migration['new_chat_id']
+                        for migration in db.ChatMigration.find()
+                    }
+
+    def resolve(self, chat_id):
+        """Return the new id if the chat was migrated, else the same id"""
+        self._ensure_loaded()
+        # a supergroup can't be migrated again, but a chain costs nothing to follow
+        while chat_id in self._new_ids:
+            chat_id = self._new_ids[chat_id]
+        return chat_id
+
+    def register(self, old_chat_id, new_chat_id):
+        self._ensure_loaded()
+        with self._lock:
+            if self._new_ids.get(old_chat_id) == new_chat_id:
+                return
+            self._new_ids[old_chat_id] = new_chat_id
+        logger.info('Chat %s is migrated to %s', old_chat_id, new_chat_id)
+        db.ChatMigration.create({
+            'old_chat_id': old_chat_id, 'new_chat_id': new_chat_id, 'migrated': False,
+        })
+        self._schedule(old_chat_id, new_chat_id)
+
+    def _schedule(self, old_chat_id, new_chat_id):
+        delay_queue.schedule(0, self.migrate_storage, old_chat_id, new_chat_id)
+
+    def migrate_storage(self, old_chat_id, new_chat_id):
+        """Rewrite the old chat id in objects of all models"""
+        migrated = 0
+        for model in db.models:
+            migrated += model.migrate_chat_id(old_chat_id, new_chat_id)
+        db.ChatMigration.update_one({'old_chat_id': old_chat_id}, {'migrated': True})
+        logger.info('%s stored objects migrated to chat %s', migrated, new_chat_id)
@@ -0,0 +1,99 @@
+"""
+Retry policy of API calls: backoff between attempts and circuit breakers
+"""
+import random, threading, time
+
+import settings
+from meetg.stats import service_cache
+
+
+def get_backoff_delay(attempt):
+    """
+    Exponential backoff with "equal jitter": a half of the delay is fixed,
+    another half is random, so threads retrying after the same error
+    don't hit Telegram in lockstep
+    """
+    delay = min(settings.network_error_wait * 2 ** (attempt - 1), settings.network_error_max_wait)
+    if settings.network_error_jitter:
+        delay = delay / 2 + random.uniform(0, delay / 2)
+    return delay
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing endpoint. After the threshold of consecutive
+    failures it opens and calls fail fast. After the timeout it becomes
+    half-open and lets one probe call through: if it succeeds,
+    the breaker closes, otherwise it opens again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.reported_trips = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may be made now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+
+            return True
+
+    def release_probe(self):
+        """Let another call probe, if the probe call ended without an answer of the endpoint"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """Return the app-wide circuit breaker of the endpoint, or None if they are disabled"""
+    if not settings.circuit_breaker_threshold:
+        return None
+    breakers = service_cache['stats']['breaker']
+    breaker = breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    settings.circuit_breaker_threshold, settings.circuit_breaker_timeout,
+                )
+                breakers[name] = breaker
+    return breaker
@@ -0,0 +1,152 @@
+"""
+Routing of incoming updates to handlers, without checking each handler in turn
+"""
+from telegram import MessageEntity
+from telegram.constants import UPDATE_ALL_TYPES
+from telegram.ext import (
+    CallbackQueryHandler, ChatMemberHandler, ChosenInlineResultHandler, CommandHandler, Handler,
+    InlineQueryHandler, MessageHandler, PollAnswerHandler, PollHandler, PreCheckoutQueryHandler,
+    PrefixHandler, ShippingQueryHandler,
+)
+
+
+MESSAGE_UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+# Update types a handler class may ever accept. Handlers of other classes are checked always
+handler_update_types = {
+    CommandHandler: MESSAGE_UPDATE_TYPES,
+    PrefixHandler: MESSAGE_UPDATE_TYPES,
+    MessageHandler: MESSAGE_UPDATE_TYPES,
+    CallbackQueryHandler: ('callback_query', ),
+    InlineQueryHandler: ('inline_query', ),
+    ChosenInlineResultHandler: ('chosen_inline_result', ),
+    ShippingQueryHandler: ('shipping_query', ),
+    PreCheckoutQueryHandler: ('pre_checkout_query', ),
+    PollHandler: ('poll', ),
+    PollAnswerHandler: ('poll_answer', ),
+    ChatMemberHandler: ('my_chat_member', 'chat_member'),
+}
+
+
+def get_handler_update_types(handler):
+    """Return update types the handler may accept, or None if it can be any"""
+    for handler_cls in type(handler).__mro__:
+        if handler_cls in handler_update_types:
+            return handler_update_types[handler_cls]
+
+
+def get_routing_update_type(update):
+    """Faster analogue of utils.get_update_type(), which doesn't serialize the update"""
+    for update_type in UPDATE_ALL_TYPES:
+        if getattr(update, update_type, None) is not None:
+            return update_type
+
+
+def get_command(message):
+    """Extract the command the same way CommandHandler does"""
+    entities = message.entities
+    if entities and message.text:
+        entity = entities[0]
+        if entity.type == MessageEntity.BOT_COMMAND and entity.offset == 0:
+            return message.text[1:entity.length].split('@')[0].lower()
+
+
+def get_prefix_command(message):
+    """Extract the command the same way PrefixHandler does"""
+    if message.text:
+        words = message.text.split()
+        if words:
+            return words[0].lower()
+
+
+class HandlerRouter:
+    """
+    Pre-indexes handlers by update type and command name,
+    so an update is checked only against handlers that could match it.
+    The first matching handler wins, in the order the handlers were given
+    """
+    def __init__(self, handlers):
+        self.handlers = tuple(handlers)
+        self._commands = set()
+        self._prefix_commands = set()
+        self._specs = [self._get_spec(handler) for handler in self.handlers]
+        self._routes = {}
+
+    def _get_spec(self, handler):
+        update_types = get_handler_update_types(handler)
+        commands = prefix_commands = None
+
+        if isinstance(handler, PrefixHandler):
+            prefix_commands = set(handler._commands)
+            self._prefix_commands.update(prefix_commands)
+        elif isinstance(handler, CommandHandler):
+            commands = set(handler.command)
+            self._commands.update(commands)
+
+        return update_types, commands, prefix_commands
+
+    def _build_route(self, key):
+        update_type, command, prefix_command = key
+        route = []
+        for handler, (update_types, commands, prefix_commands) in zip(self.handlers, self._specs):
+            if update_types is not None and update_type not in update_types:
+                continue
+            if commands is not None and command not in commands:
+                continue
+            if prefix_commands is not None and prefix_command not in prefix_commands:
+                continue
+            route.append(handler)
+        return tuple(route)
+
+    def _get_key(self, update):
+        update_type = get_routing_update_type(update)
+        command = prefix_command = None
+
+        if update_type in MESSAGE_UPDATE_TYPES:
+            message = update.effective_message
+            if self._commands:
+                command = get_command(message)
+                if command not in self._commands:
+                    command = None
+            if self._prefix_commands:
+                prefix_command = get_prefix_command(message)
+                if prefix_command not in self._prefix_commands:
+                    prefix_command = None
+
+        return update_type, command, prefix_command
+
+    def get_handlers(self, update):
+        """Return handlers that could match the update, in their original order"""
+        key = self._get_key(update)
+        route = self._routes.get(key)
+        if route is None:
+            route = self._build_route(key)
+            self._routes[key] = route
+        return route
+
+    def route(self, update):
+        """Return the first matching handler and its check_update() result"""
+        for handler in self.get_handlers(update):
+            check = handler.check_update(update)
+            if check not in (None, False):
+                return handler, check
+        return None, None
+
+
+class RoutingHandler(Handler):
+    """
+    The only handler added to the PTB dispatcher.
+    It delegates the update to the handler found by HandlerRouter
+    """
+    def __init__(self, router):
+        super().__init__(lambda update, context: None)
+        self.router = router
+
+    def check_update(self, update):
+        handler, check = self.router.route(update)
+        if handler is not None:
+            return handler, check
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        handler, check = check_result
+        return handler.handle_update(update, dispatcher, check, context)
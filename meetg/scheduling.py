@@ -0,0 +1,63 @@
+"""
+Delayed execution of functions without blocking the calling thread
+"""
+import heapq, itertools, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from meetg.loging import get_logger
+
+
+logger = get_logger()
+
+
+class DelayQueue:
+    """
+    Heap of functions ordered by the time they are due.
+    One thread waits for the nearest one and passes due functions
+    to a small pool of workers, so a slow function doesn't delay others
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def _start(self):
+        workers = self.workers or settings.delay_queue_workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='meetg_delay')
+        self._thread = threading.Thread(target=self._loop, name='meetg_delay_queue', daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, func, *args):
+        """Call func(*args) in a worker thread after delay seconds"""
+        due = time.monotonic() + max(delay, 0)
+        with self._condition:
+            if self._thread is None:
+                self._start()
+            heapq.heappush(self._heap, (due, next(self._counter), func, args))
+            self._condition.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                due, _, func, args = heapq.heappop(self._heap)
+            self._executor.submit(self._run, func, args)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Delayed %s failed', getattr(func, '__name__', func))
+
+
+"""App-wide queue of delayed functions"""
+delay_queue = DelayQueue()
@@ -0,0 +1,126 @@
+"""
+Durable outbox of API calls, sent by background workers
+"""
+import queue, threading
+from concurrent.futures import Future
+
+import telegram
+
+import settings
+from meetg.api_methods import ApiCall
+from meetg.loging import get_logger
+from meetg.storage import db
+
+
+logger = get_logger()
+
+
+def serialize_args(args):
+    """Return args storable in storage, or None if some of them aren't, like file content"""
+    serialized = {}
+    for key, value in args.items():
+        if isinstance(value, telegram.TelegramObject):
+            value = value.to_dict()
+        elif isinstance(value, list) and not all(isinstance(i, (str, int)) for i in value):
+            # e.g. media of a group, with files
+            return None
+        elif not isinstance(value, (str, int, float, bool, type(None), list, dict)):
+            return None
+        serialized[key] = value
+    return serialized
+
+
+class Outbox:
+    """
+    Calls are saved to storage and sent by a pool of workers, so handlers don't wait
+    for Telegram and calls not sent yet survive restarts. Calls to a chat are always sent
+    by the same worker, in the order they were made
+    """
+    def __init__(self, methods, workers=None):
+        self.methods = methods
+        self.workers = workers or settings.outbox_workers
+        self._queues = []
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Start workers and enqueue calls left from the previous run"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for number in range(self.workers):
+                calls = queue.Queue()
+                self._queues.append(calls)
+                thread = threading.Thread(
+                    target=self._work, args=(calls,), name=f'meetg_outbox_{number}', daemon=True,
+                )
+                thread.start()
+
+        left = db.Outbox.find({'status': {'$in': ['pending', 'sending']}})
+        left = list(left.sort([('_created_at', 1), ('_id', 1)]))
+        if left:
+            logger.info('Resuming %s calls left in the outbox', len(left))
+        for entry in left:
+            self._enqueue(entry)
+
+    def get_depth(self):
+        """Number of calls waiting for workers, read without locks of the queues"""
+        return sum(len(calls.queue) for calls in self._queues)
+
+    def put(self, record):
+        """Save the call to storage, return a Future with its result or None if it can't be saved"""
+        args = serialize_args(record.args)
+        if args is None:
+            return None
+        self.start()
+        entry = {
+            'method': record.name, 'args': args, 'chat_id': args.get('chat_id'),
+            'status': 'pending', 'attempts': 0,
+        }
+        entry['_id'] = db.Outbox.create(entry).inserted_id
+        future = Future()
+        with self._lock:
+            self._futures[entry['_id']] = future
+        self._enqueue(entry, record)
+        return future
+
+    def _enqueue(self, entry, record=None):
+        # calls to a chat are ordered by one worker
+        number = hash(entry['chat_id']) % self.workers
+        self._queues[number].put((entry, record))
+
+    def _work(self, calls):
+        while True:
+            entry, record = calls.get()
+            try:
+                self._send(entry, record)
+            except Exception as exc:
+                logger.exception('Failed to send call %s from the outbox', entry['_id'])
+                with self._lock:
+                    future = self._futures.pop(entry['_id'], None)
+                if future:
+                    future.set_exception(exc)
+
+    def _send(self, entry, record=None):
+        query = {'_id': entry['_id']}
+        method = self.methods[entry['method']]
+        if record is None:
+            record = ApiCall(method)
+            record.args = entry['args']
+        db.Outbox.update_one(query, {'status': 'sending', 'attempts': entry['attempts'] + 1})
+
+        result = method.send_now(record)
+        if isinstance(result, Future):
+            result = result.result()
+
+        if record.success:
+            db.Outbox.delete_one(query)
+        else:
+            db.Outbox.update_one(query, {'status': 'failed', 'response': str(record.response)})
+
+        with self._lock:
+            future = self._futures.pop(entry['_id'], None)
+        if future:
+            future.set_result(result)
@@ -1,8 +1,11 @@
+import bisect, threading
+from array import array
+
 import psutil
 
+from meetg import storage
 from meetg.loging import get_logger
-from meetg.storage import db
-from meetg.utils import get_current_unixtime, get_unixtime_before_now, true_only
+from meetg.utils import get_current_unixtime, true_only
 
 
 logger = get_logger()
@@ -55,64 +58,249 @@ class DateSegment(list):
         return self[-1] - self[0]
 
 
-class DateCache(list):
+class MinuteCounter:
     """
-    List to easy store and get back date objects: points and segments.
-    Useful to store runtime stats, to later report them.
-    Usage:
-    cache = DateCache()
-    cache.add() - add current Unix time to cache
-    cache.get_day_count() - return number of additions happened for the last 24 hours
+    Counts of events per minute for the last 24 hours, in a ring of 1440 slots.
+    Memory doesn't depend on the number of events, and adding one is O(1).
+    Each slot remembers its minute, so stale slots are reset on reuse and skipped in sums
     """
-    def add(self, obj=None):
-        if obj is None:
-            obj = get_current_unixtime()
-        return self.append(obj)
-
-    def _get_day_treshold(self):
-        day_before = get_unixtime_before_now(24)
-        for i, item in enumerate(self):
-            to_compare = item
-            if isinstance(item, list):
-                to_compare = item[-1]
-            if to_compare >= day_before:
-                return i
+    size = 24 * 60
 
-    def get_day(self):
-        treshold = self._get_day_treshold()
-        if treshold is not None:
-            return self[treshold:]
+    def __init__(self):
+        self._counts = array('Q', bytes(8 * self.size))
+        self._minutes = array('q', [-1]) * self.size
+        self._lock = threading.Lock()
+        # all events ever counted
+        self.total = 0
+
+    def add(self, now=None, count=1):
+        minute = int((get_current_unixtime() if now is None else now) // 60)
+        slot = minute % self.size
+        with self._lock:
+            if self._minutes[slot] != minute:
+                self._minutes[slot] = minute
+                self._counts[slot] = 0
+            self._counts[slot] += count
+            self.total += count
+
+    def get_day_count(self, now=None):
+        """Number of events for the last 24 hours"""
+        minute = int((get_current_unixtime() if now is None else now) // 60)
+        oldest = minute - self.size
+        with self._lock:
+            return sum(
+                count for count, slot_minute in zip(self._counts, self._minutes)
+                if oldest < slot_minute <= minute
+            )
+
+
+class Histogram:
+    """
+    Compact histogram of durations: counts in buckets with bounds growing by 1.5 times,
+    from 1 ms to about 2 hours. Percentiles are precise up to the bucket width
+    """
+    bounds = tuple(0.001 * 1.5 ** i for i in range(40))
 
-    def get_day_count(self):
-        last_day = self.get_day()
-        return len(last_day)
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        # max of values added since the last report, the overall max is stale in reports
+        self.max_since_report = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.max_since_report = max(self.max_since_report, value)
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        histogram.max_since_report = self.max_since_report
+        return histogram
+
+    def __sub__(self, other):
+        """Histogram of values added since the other snapshot of this one"""
+        histogram = Histogram()
+        histogram.counts = [count - old for count, old in zip(self.counts, other.counts)]
+        histogram.count = self.count - other.count
+        histogram.total = self.total - other.total
+        histogram.max = self.max_since_report if histogram.count else 0
+        histogram.max_since_report = histogram.max
+        return histogram
+
+    def get_percentile(self, percent):
+        """Return the upper bound of the bucket with the percentile, 0 if empty"""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                bound = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+
+class CountingStats:
+    """
+    Base class for counters and histograms, which can be
+    reported as diffs of their snapshots since the last report
+    """
+    counter_names = ()
+    histogram_names = ()
 
-    def get_day_duration(self):
+    def __init__(self):
+        for name in self.counter_names:
+            setattr(self, name, 0)
+        for name in self.histogram_names:
+            setattr(self, name, Histogram())
+        self._lock = threading.Lock()
+        self._reported = None
+
+    def _copy(self):
+        snapshot = {name: getattr(self, name) for name in self.counter_names}
+        for name in self.histogram_names:
+            snapshot[name] = getattr(self, name).copy()
+        return snapshot
+
+    def snapshot(self):
+        with self._lock:
+            return self._copy()
+
+    def peek(self):
         """
-        Method only for Segments. Count duration
-        of date segments added for the last 24 hours
+        Snapshot without the lock, for readers which must not slow down writers.
+        Its numbers may be a few events apart
         """
-        last_day = self.get_day()
-        total = 0
-        for segment in last_day:
-            if not isinstance(segment, DateSegment):
-                raise RuntimeError('get_day_duration() is only applicable for DateSegments')
-            total += segment.get_duration()
-        return total
+        return self._copy()
+
+    def get_since_report(self, mark_reported=False):
+        """Snapshot diff since the last report"""
+        with self._lock:
+            snapshot = self._copy()
+            if mark_reported:
+                for name in self.histogram_names:
+                    getattr(self, name).max_since_report = 0
+        reported = self._reported
+        if mark_reported:
+            self._reported = snapshot
+        if reported is None:
+            return snapshot
+        names = self.counter_names + self.histogram_names
+        return {name: snapshot[name] - reported[name] for name in names}
+
+
+class ApiMethodStats(CountingStats):
+    """
+    Counters of calls of an API method and a histogram of their durations.
+    retry_after is seconds waited as Telegram asked by RetryAfter errors
+    """
+    counter_names = ('calls', 'successes', 'failures', 'retries', 'retry_after')
+    histogram_names = ('latency', )
+
+    def add_call(self, success, attempts, duration):
+        with self._lock:
+            self.calls += 1
+            if success:
+                self.successes += 1
+            else:
+                self.failures += 1
+            self.retries += max(attempts - 1, 0)
+            self.latency.add(duration)
+
+    def add_retry_after(self, seconds):
+        with self._lock:
+            self.retry_after += seconds
+
+
+class StorageStats(CountingStats):
+    """Durations of a storage operation of a model"""
+    histogram_names = ('latency', )
+
+    def add(self, duration):
+        with self._lock:
+            self.latency.add(duration)
+
+
+class JobStats(CountingStats):
+    """
+    Runs of a job: histograms of their durations and lags,
+    how late each run started after the planned time
+    """
+    counter_names = ('runs', )
+    histogram_names = ('duration', 'lag')
+
+    def add_run(self, duration, lag=None):
+        with self._lock:
+            self.runs += 1
+            self.duration.add(duration)
+            if lag is not None:
+                self.lag.add(max(lag, 0))
+
+
+def get_api_stats(since_report=False):
+    """
+    Return stats of API methods by their names: counters and latency
+    percentiles in seconds, overall or since the last daily report
+    """
+    stats = {}
+    for name, method_stats in service_cache['stats']['api'].items():
+        if since_report:
+            snapshot = method_stats.get_since_report()
+        else:
+            snapshot = method_stats.snapshot()
+        latency = snapshot.pop('latency')
+        for percent in (50, 95, 99):
+            snapshot[f'p{percent}'] = latency.get_percentile(percent)
+        snapshot['max'] = latency.max
+        stats[name] = snapshot
+    return stats
 
-    def clear_before_last_day(self):
-        treshold = self._get_day_treshold()
-        if treshold is not None:
-            del self[:treshold]
+
+def get_api_reports():
+    """Get API call stats since the last report and format them"""
+    reports = []
+    for name, method_stats in service_cache['stats']['api'].items():
+        stats = method_stats.get_since_report(mark_reported=True)
+        if not stats['calls']:
+            continue
+        latency = stats['latency']
+        line = (
+            f"{name}: {stats['calls']} calls, {stats['failures']} failed, "
+            f"{stats['retries']} retries, waited {stats['retry_after']} seconds by RetryAfter, "
+            f"latency p50 {latency.get_percentile(50):.3f}, p95 {latency.get_percentile(95):.3f}, "
+            f"p99 {latency.get_percentile(99):.3f} seconds"
+        )
+        reports.append(line)
+    return reports
 
 
 def get_job_reports():
-    """Get gathered info from service_cache['stats']['job'] and format it"""
+    """Get job stats since the last report and format them"""
     reports = []
-    for job_name, segments in service_cache['stats']['job'].items():
-        segments.clear_before_last_day()
-        duration = segments.get_day_duration()
-        line = f'{job_name} took {duration:.3f} seconds total'
+    for job_name, job_stats in service_cache['stats']['job'].items():
+        stats = job_stats.get_since_report(mark_reported=True)
+        if not stats['runs']:
+            continue
+        duration, lag = stats['duration'], stats['lag']
+        line = (
+            f"{job_name} took {duration.total:.3f} seconds total in {stats['runs']} runs, "
+            f"p50 {duration.get_percentile(50):.3f}, p95 {duration.get_percentile(95):.3f}, "
+            f"p99 {duration.get_percentile(99):.3f}, max {duration.max:.3f} seconds"
+        )
+        if lag.count:
+            line += (
+                f", started late by p50 {lag.get_percentile(50):.3f}, "
+                f"p99 {lag.get_percentile(99):.3f}, max {lag.max:.3f} seconds"
+            )
         reports.append(line)
     return reports
 
@@ -120,16 +308,27 @@ def get_job_reports():
 def get_update_reports():
     """Get gathered info from service_cache['stats']['update'] and format it"""
     update_reports = []
-    for update_type, dates in service_cache['stats']['update'].items():
-        dates.clear_before_last_day()
-        count = dates.get_day_count()
+    for update_type, counter in service_cache['stats']['update'].items():
+        count = counter.get_day_count()
         line = f"received {count} '{update_type}' updates"
         update_reports.append(line)
     return update_reports
 
 
+def get_breaker_reports():
+    """Report circuit breakers which aren't closed or tripped since the last report"""
+    reports = []
+    for name, breaker in service_cache['stats']['breaker'].items():
+        trips = breaker.trips - breaker.reported_trips
+        breaker.reported_trips = breaker.trips
+        if trips or breaker.state != breaker.CLOSED:
+            line = f'{name} circuit breaker is {breaker.state}, tripped {trips} times'
+            reports.append(line)
+    return reports
+
+
 def get_model_reports():
-    reports = [model.get_day_report() for model in db.models]
+    reports = [model.get_day_report() for model in storage.db.models]
     return true_only(reports)
 
 
@@ -148,29 +347,42 @@ def get_sys_reports():
 def get_reports():
     update_reports = get_update_reports()
     model_reports = get_model_reports()
+    api_reports = get_api_reports()
     job_reports = get_job_reports()
+    breaker_reports = get_breaker_reports()
     sys_reports = get_sys_reports()
-    return update_reports + model_reports + job_reports + sys_reports
+    return (
+        update_reports + model_reports + api_reports + job_reports + breaker_reports + sys_reports
+    )
 
 
 class _SaveTimeJobQueueWrapper:
     """
-    A wrapper to measure job time execution,
+    A wrapper to measure job time execution and how late jobs start,
     to report it in stats
     """
     def __init__(self, job_queue):
         self.job_queue = job_queue
         self._wrapped_callbacks = []
+        # planned time of the next run by job ids
+        self._planned = {}
 
     def _wrap(self, callback, *args, **kwargs):
 
         def wrapped(*args, **kwargs):
-            service_cache['stats']['job'].init(DateCache)
+            started_at = get_current_unixtime()
+            job = getattr(args[0], 'job', None) if args else None
+            planned_at = self._planned.pop(job.id, None) if job else None
             segment = DateSegment()
             result = callback(*args, **kwargs)
             segment.finish()
-            logger.info('%s executed in %.3f seconds', callback.__name__, segment.get_duration())
-            service_cache['stats']['job'][callback.__name__].add(segment)
+            duration = segment.get_duration()
+            logger.info('%s executed in %.3f seconds', callback.__name__, duration)
+
+            lag = started_at - planned_at if planned_at else None
+            self._remember_planned(job, started_at)
+            service_cache['stats']['job'].init(JobStats)
+            service_cache['stats']['job'][callback.__name__].add_run(duration, lag)
             return result
 
         wrapped.__doc__ = callback.__doc__
@@ -181,22 +393,38 @@ class _SaveTimeJobQueueWrapper:
         self._wrapped_callbacks.append(wrapped)
         return wrapped
 
+    def _remember_planned(self, job, after=None):
+        """
+        Remember the planned time of the next run of the job. The scheduler sets it
+        around the start of the current run, so it's not taken if it isn't set yet
+        """
+        try:
+            next_t = job.next_t if job else None
+        except AttributeError:
+            # jobs added before the job queue is started have no planned time yet
+            next_t = None
+        if next_t:
+            planned_at = next_t.timestamp()
+            if after is None or planned_at > after:
+                self._planned[job.id] = planned_at
+        return job
+
     def run_once(self, callback, *args, **kwargs):
         wrapped = self._wrap(callback, *args, **kwargs)
-        return self.job_queue.run_once(wrapped, *args, **kwargs)
+        return self._remember_planned(self.job_queue.run_once(wrapped, *args, **kwargs))
 
     def run_repeating(self, callback, *args, **kwargs):
         wrapped = self._wrap(callback)
-        return self.job_queue.run_repeating(wrapped, *args, **kwargs)
+        return self._remember_planned(self.job_queue.run_repeating(wrapped, *args, **kwargs))
 
     def run_monthly(self, callback, *args, **kwargs):
         wrapped = self._wrap(callback)
-        return self.job_queue.run_monthly(wrapped, *args, **kwargs)
+        return self._remember_planned(self.job_queue.run_monthly(wrapped, *args, **kwargs))
 
     def run_daily(self, callback, *args, **kwargs):
         wrapped = self._wrap(callback)
-        return self.job_queue.run_daily(wrapped, *args, **kwargs)
+        return self._remember_planned(self.job_queue.run_daily(wrapped, *args, **kwargs))
 
     def run_custom(self, callback, *args, **kwargs):
         wrapped = self._wrap(callback)
-        return self.job_queue.run_custom(wrapped, *args, **kwargs)
+        return self._remember_planned(self.job_queue.run_custom(wrapped, *args, **kwargs))
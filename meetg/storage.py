@@ -1,6 +1,9 @@
+import threading, time
+
 import pymongo
 
 import settings
+from meetg import stats
 from meetg.api_types import (
     ApiType, ChatApiType, MessageApiType, UpdateApiType, UserApiType,
 )
@@ -10,6 +13,8 @@ from meetg.loging import get_logger
 
 logger = get_logger()
 
+_stats_lock = threading.Lock()
+
 
 class AbstractStorage:
     """Any other storage must be a subclass of this class"""
@@ -26,7 +31,7 @@ class AbstractStorage:
     def update(self, query, update):
         raise NotImplementedError
 
-    def update_one(self, query, update):
+    def update_one(self, query, update, upsert=False):
         raise NotImplementedError
 
     def count(self, query=None):
@@ -44,6 +49,9 @@ class AbstractStorage:
     def delete_one(self, query):
         raise NotImplementedError
 
+    def create_unique_index(self, fields):
+        raise NotImplementedError
+
     def drop(self):
         raise NotImplementedError
 
@@ -67,8 +75,8 @@ class MongoStorage(AbstractStorage):
     def update(self, query, new_data):
         return self.table.update_many(query, {'$set': new_data})
 
-    def update_one(self, query, new_data):
-        return self.table.update_one(query, {'$set': new_data})
+    def update_one(self, query, new_data, upsert=False):
+        return self.table.update_one(query, {'$set': new_data}, upsert=upsert)
 
     def count(self, query=None):
         return self.table.count_documents(query or {})
@@ -85,6 +93,10 @@ class MongoStorage(AbstractStorage):
     def delete_one(self, query):
         return self.table.delete_one(query)
 
+    def create_unique_index(self, fields):
+        keys = [(field, pymongo.ASCENDING) for field in fields]
+        return self.table.create_index(keys, unique=True)
+
     def drop(self):
         return self.db.drop_collection(self.table_name)
 
@@ -96,6 +108,10 @@ class BaseModel:
     """
     fields = ()
     special_fields = ('_created_at', '_modified_at')
+    # fields with chat ids, rewritten when a group is migrated to a supergroup
+    chat_id_fields = ()
+    # fields whose values are unique together, indexed in storage
+    unique_fields = ()
 
     def __init__(self, test=False):
         db_name = settings.db_name_test if test else settings.db_name
@@ -104,6 +120,8 @@ class BaseModel:
             db_name=db_name, table_name=self.table_name,
             host=settings.db_host, port=settings.db_port,
         )
+        if self.unique_fields:
+            self._storage.create_unique_index(self.unique_fields)
 
     @property
     def name_lower(self):
@@ -135,13 +153,29 @@ class BaseModel:
     def _log_absent_field(self, field):
         logger.warning('Field %s doesn\'t belong to model %s', field, self.name)
 
+    def _measure(self, operation, started_at):
+        """Record the duration of the operation, find() isn't measured as its cursor is lazy"""
+        duration = time.perf_counter() - started_at
+        storage_stats = stats.service_cache['stats']['storage']
+        key = self.name, operation
+        model_stats = storage_stats.get(key)
+        if model_stats is None:
+            with _stats_lock:
+                model_stats = storage_stats.get(key)
+                if model_stats is None:
+                    model_stats = stats.StorageStats()
+                    storage_stats[key] = model_stats
+        model_stats.add(duration)
+
     def create(self, data: dict):
         data = self._validate(data)
         result = None
         if data:
             data['_created_at'] = get_current_unixtime()
             data['_modified_at'] = None
+            started_at = time.perf_counter()
             result = self._storage.create(data)
+            self._measure('create', started_at)
             self._log_create(data)
         return result
 
@@ -150,26 +184,49 @@ class BaseModel:
         return found
 
     def find_one(self, query=None):
+        started_at = time.perf_counter()
         found = self._storage.find_one(query)
+        self._measure('find_one', started_at)
         return found
 
     def update(self, query, new_data):
         new_data = self._validate(new_data)
         new_data['_modified_at'] = get_current_unixtime()
+        started_at = time.perf_counter()
         updated = self._storage.update(query, new_data)
+        self._measure('update', started_at)
         return updated
 
-    def update_one(self, query, new_data):
+    def update_one(self, query, new_data, upsert=False):
         new_data = self._validate(new_data)
         new_data['_modified_at'] = get_current_unixtime()
-        updated = self._storage.update_one(query, new_data)
+        started_at = time.perf_counter()
+        updated = self._storage.update_one(query, new_data, upsert=upsert)
+        self._measure('update_one', started_at)
         self._log_update(query)
         return updated
 
+    def delete_one(self, query):
+        started_at = time.perf_counter()
+        deleted = self._storage.delete_one(query)
+        self._measure('delete_one', started_at)
+        return deleted
+
     def count(self, query=None):
+        started_at = time.perf_counter()
         counted = self._storage.count(query)
+        self._measure('count', started_at)
         return counted
 
+    def migrate_chat_id(self, old_chat_id, new_chat_id):
+        """Replace the old chat id in all objects, return the number of updated ones"""
+        migrated = 0
+        for field in self.chat_id_fields:
+            data = {field: new_chat_id, '_modified_at': get_current_unixtime()}
+            result = self._storage.update({field: old_chat_id}, data)
+            migrated += result.modified_count
+        return migrated
+
     def _get_created_for_day_query(self):
         query = {
             '_created_at': {
@@ -261,6 +318,7 @@ class DefaultMessageModel(ApiTypeModel):
 
     name = api_type.name
     fields = api_type.fields
+    chat_id_fields = ('chat.id', )
     save_on_update = True
 
     def get_ptb_obj(self, update):
@@ -293,9 +351,19 @@ class DefaultChatModel(ApiTypeModel):
 
     name = api_type.name
     fields = api_type.fields
-    special_fields = BaseModel.special_fields + ('_kicked_at', )
+    special_fields = BaseModel.special_fields + (
+        '_kicked_at', '_undeliverable', '_undeliverable_at',
+    )
+    chat_id_fields = ('id', )
     save_on_update = True
 
+    def migrate_chat_id(self, old_chat_id, new_chat_id):
+        """The supergroup may be stored already, then the old group is just deleted"""
+        if self.find_one({'id': new_chat_id}):
+            result = self._storage.delete({'id': old_chat_id})
+            return result.deleted_count
+        return super().migrate_chat_id(old_chat_id, new_chat_id)
+
     def get_ptb_obj(self, update):
         ptb_obj = update.effective_chat
         return ptb_obj
@@ -305,6 +373,62 @@ class DefaultChatModel(ApiTypeModel):
         return query
 
 
+class DefaultStateModel(BaseModel):
+    """
+    Key-value storage for the framework's own runtime state,
+    e.g. the offset of the last processed update
+    """
+    name = 'State'
+    fields = ('key', 'value')
+
+    def get(self, key, default=None):
+        db_obj = self.find_one({'key': key})
+        return db_obj['value'] if db_obj else default
+
+    def set(self, key, value):
+        data = {'key': key, 'value': value, '_modified_at': get_current_unixtime()}
+        return self._storage.update_one({'key': key}, data, upsert=True)
+
+    def get_day_report(self):
+        return ''
+
+
+class DefaultBroadcastModel(BaseModel):
+    """Checkpoints of broadcasts, to resume them after a crash"""
+    name = 'Broadcast'
+    fields = ('broadcast_id', 'total', 'position', 'results', 'finished')
+
+
+class DefaultFileIdModel(BaseModel):
+    """file_id of uploaded files by hashes of their content"""
+    name = 'FileId'
+    fields = ('file_type', 'hash', 'file_id')
+    unique_fields = ('file_type', 'hash')
+
+    def set(self, file_type, content_hash, file_id):
+        query = {'file_type': file_type, 'hash': content_hash}
+        return self.update_one(query, {'file_id': file_id}, upsert=True)
+
+
+class DefaultOutboxModel(BaseModel):
+    """API calls to send in background"""
+    name = 'Outbox'
+    fields = ('method', 'args', 'chat_id', 'status', 'attempts', 'response')
+    chat_id_fields = ('chat_id', 'args.chat_id')
+
+    def get_day_report(self):
+        # failed calls aren't retried, so they were modified last when they failed
+        query = {'status': 'failed', '_modified_at': {'$gte': get_unixtime_before_now(24)}}
+        failed = self.count(query)
+        return f'{failed} calls failed to be sent from the outbox'
+
+
+class DefaultChatMigrationModel(BaseModel):
+    """Ids of groups migrated to supergroups, and new ids of the supergroups"""
+    name = 'ChatMigration'
+    fields = ('old_chat_id', 'new_chat_id', 'migrated')
+
+
 def mongo_get_first(cursor):
     """Return first item in the cursor"""
     return [item for item in cursor.limit(1)][0]
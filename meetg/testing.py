@@ -26,6 +26,8 @@ class BaseTestCase(unittest.TestCase):
         self._reset_settings()
         settings.is_test = True
         settings.log_level = logging.CRITICAL
+        # not to write offsets to the storage of next tests after a delay
+        settings.update_offset_save_interval = 0
         self._reinit_loggers()
 
 
@@ -1,6 +1,16 @@
+import threading, time
+
 import telegram
 
 import settings
+from meetg.api_methods import ApiCall
+from meetg.broadcasting import Broadcast
+from meetg.caching import file_id_cache, get_content_hash
+from meetg.cleaning import Cleanup
+from meetg.factories import MessageUpdateFactory
+from meetg.migrating import ChatMigrationRegistry
+from meetg.stats import get_api_reports, get_api_stats, service_cache
+from meetg.storage import db
 from meetg.tests.base import AnyHandlerBotCase
 from meetg.testing import get_sample
 
@@ -115,6 +125,137 @@ class ReceiveTest(AnyHandlerBotCase):
         assert self.bot.last_update.effective_message.location.latitude == 45
 
 
+class RetryModeTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.network_error_wait = 0.01
+        service_cache['stats']['breaker'].clear()
+
+    def test_sleep_mode(self):
+        exception = telegram.error.NetworkError('Bad Gateway')
+        success, response = self.bot.send_message(1, 'Spam', raise_exception=exception)
+        assert success
+        assert self.bot.last_method.attempts == 2
+
+    def test_schedule_mode(self):
+        settings.api_retry_mode = 'schedule'
+        exception = telegram.error.NetworkError('Bad Gateway')
+        future = self.bot.send_message(1, 'Spam', raise_exception=exception)
+        success, response = future.result(timeout=5)
+        assert success
+        assert self.bot.last_method.attempts == 2
+
+    def test_schedule_mode_finish_failed(self):
+        settings.api_retry_mode = 'schedule'
+        method = self.bot._api_methods['send_message']
+        exception = telegram.error.NetworkError('Bad Gateway')
+
+        def handle_result(record):
+            raise RuntimeError('Storage is down')
+
+        method.handle_result = handle_result
+        future = self.bot.send_message(1, 'Spam', raise_exception=exception)
+        try:
+            future.result(timeout=5)
+            assert False
+        except RuntimeError:
+            pass
+        finally:
+            del method.handle_result
+
+    def test_circuit_breaker_fails_fast(self):
+        settings.circuit_breaker_threshold = 1
+        settings.api_attempts = 1
+        exception = telegram.error.NetworkError('Bad Gateway')
+        self.bot.send_message(1, 'Spam', raise_exception=exception)
+        success, response = self.bot.send_message(1, 'Spam')
+        service_cache['stats']['breaker'].clear()
+        assert not success
+        assert self.bot.last_method.attempts == 0
+
+    def test_circuit_breaker_probe_released(self):
+        settings.circuit_breaker_threshold = 1
+        settings.circuit_breaker_timeout = 0.01
+        settings.api_attempts = 1
+        self.bot.send_message(1, 'Spam', raise_exception=telegram.error.NetworkError('Eggs'))
+        time.sleep(0.02)
+        try:
+            self.bot.send_message(1, 'Spam', raise_exception=ValueError('Eggs'))
+            assert False
+        except ValueError:
+            pass
+        success, response = self.bot.send_message(1, 'Spam')
+        service_cache['stats']['breaker'].clear()
+        assert success
+
+    def test_schedule_mode_no_retry(self):
+        settings.api_retry_mode = 'schedule'
+        future = self.bot.send_message(1, 'Spam')
+        assert future.done()
+        assert future.result() == (True, '')
+
+
+class ApiDispatchTest(AnyHandlerBotCase):
+
+    def test_method_resolved_once(self):
+        send_message = self.bot.send_message
+        self.bot.send_message(1, 'Spam')
+        assert self.bot.send_message is send_message
+        assert self.bot.last_method.method is self.bot._api_methods['send_message']
+
+    def test_call_record_per_call(self):
+        self.bot.send_message(1, 'Spam')
+        first_call = self.bot.last_method
+        self.bot.send_message(2, 'Eggs')
+        assert self.bot.last_method is not first_call
+        assert first_call.args['chat_id'] == 1
+        assert self.bot.last_method.args['chat_id'] == 2
+
+    def test_unknown_method(self):
+        with self.assertRaises(NameError):
+            self.bot.send_spam(1)
+
+
+class DuplicateUpdateTest(AnyHandlerBotCase):
+
+    def test_duplicate_dropped(self):
+        update = MessageUpdateFactory(self.bot._tgbot, 'message').create(text='Spam')
+        self.bot._simulate_process_update(update)
+        assert self.bot.last_method.name == 'send_message'
+
+        self.bot.last_method = None
+        self.bot._simulate_process_update(update)
+        assert not self.bot.last_method
+
+    def test_different_updates_processed(self):
+        self.bot.receive_message('Spam')
+        self.bot.last_method = None
+        self.bot.receive_message('Spam')
+        assert self.bot.last_method.name == 'send_message'
+
+
+class RequestKwargsTest(AnyHandlerBotCase):
+
+    def test_pool_size_by_workers(self):
+        settings.updater_workers = 10
+        settings.broadcast_workers = 20
+        settings.delay_queue_workers = 2
+        settings.cleanup_workers = 3
+        request_kwargs = self.bot._get_request_kwargs()
+        assert request_kwargs['con_pool_size'] == 39
+        assert 'proxy_url' not in request_kwargs
+
+    def test_pool_size_set(self):
+        settings.con_pool_size = 3
+        assert self.bot._get_request_kwargs()['con_pool_size'] == 3
+
+    def test_proxy(self):
+        settings.proxy_url = 'socks5://localhost:1080'
+        request_kwargs = self.bot._get_request_kwargs()
+        assert request_kwargs['proxy_url'] == 'socks5://localhost:1080'
+
+
 class ErrorTest(AnyHandlerBotCase):
 
     def test_chat_migrated(self):
@@ -124,6 +265,369 @@ class ErrorTest(AnyHandlerBotCase):
         assert self.bot.last_method.args['chat_id'] == 2
 
 
+class BroadcastTest(AnyHandlerBotCase):
+
+    def test_results(self):
+        results = self.bot.send_messages([1, 2, 3], 'Spam')
+        assert results['sent'] == 3
+        assert results['failed'] == 0
+
+    def test_kicked_skipped(self):
+        db.Chat.create({'id': 2, 'type': 'private', '_kicked_at': 1})
+        results = self.bot.send_messages([1, 2, 3], 'Spam')
+        assert results['sent'] == 2
+        assert results['skipped'] == 1
+
+    def test_checkpoint_saved(self):
+        self.bot.send_messages([1, 2, 3], 'Spam', broadcast_id='spam')
+        checkpoint = db.Broadcast.find_one({'broadcast_id': 'spam'})
+        assert checkpoint['finished']
+        assert checkpoint['position'] == 3
+
+    def test_resumed(self):
+        db.Broadcast.create({
+            'broadcast_id': 'spam', 'total': 3, 'position': 2, 'finished': False,
+            'results': {'sent': 2, 'failed': 0, 'blocked': 0, 'migrated': 0, 'skipped': 0},
+        })
+        results = self.bot.send_messages([1, 2, 3], 'Spam', broadcast_id='spam')
+        assert results['sent'] == 3
+        assert self.bot.last_method.args['chat_id'] == 3
+
+
+    def test_checkpoint_in_order(self):
+        broadcast = Broadcast(self.bot, [1, 2, 3], 'Spam', broadcast_id='spam')
+        broadcast._started_at = broadcast._logged_at = time.monotonic()
+        broadcast._load_checkpoint()
+        broadcast._complete(1, 'sent')
+        broadcast._save_checkpoint()
+        checkpoint = db.Broadcast.find_one({'broadcast_id': 'spam'})
+        assert checkpoint['position'] == 0
+        assert checkpoint['results']['sent'] == 0
+
+        broadcast._complete(0, 'failed')
+        broadcast._save_checkpoint()
+        checkpoint = db.Broadcast.find_one({'broadcast_id': 'spam'})
+        assert checkpoint['position'] == 2
+        assert checkpoint['results']['sent'] == 1
+        assert checkpoint['results']['failed'] == 1
+
+class DeliverabilityTest(AnyHandlerBotCase):
+
+    def test_blocked_skipped(self):
+        exc = telegram.error.Unauthorized('Forbidden: bot was blocked by the user')
+        assert self.bot.send_message(1, 'Spam', raise_exception=exc) == (False, exc.message)
+        assert self.bot._deliverability.get(1) == 'blocked'
+
+        assert self.bot.send_photo(1, 'spam_id') == (False, 'Chat is blocked')
+        assert self.bot.last_method.attempts == 0
+
+    def test_unknown_chat_stored(self):
+        self.bot._deliverability.mark(5, 'blocked')
+        assert db.Chat.find_one({'id': 5})['_undeliverable'] == 'blocked'
+
+    def test_not_found_chat_not_stored(self):
+        self.bot._deliverability.mark(5, 'not found')
+        assert self.bot._deliverability.get(5) == 'not found'
+        assert db.Chat.find_one({'id': 5}) is None
+
+    def test_forward_source_not_found(self):
+        exc = telegram.error.BadRequest('Chat not found')
+        self.bot.forward_message(1, 2, 3, raise_exception=exc)
+        assert self.bot._deliverability.get(1) is None
+        assert self.bot._deliverability.get(2) is None
+
+    def test_cleared_by_update(self):
+        self.bot.receive_message('Spam', chat__id=1)
+        exc = telegram.error.BadRequest('Chat not found')
+        self.bot.send_message(1, 'Spam', raise_exception=exc)
+        assert db.Chat.find_one({'id': 1})['_undeliverable'] == 'not found'
+
+        self.bot.receive_message('Spam', chat__id=1)
+        assert self.bot._deliverability.get(1) is None
+        assert db.Chat.find_one({'id': 1})['_undeliverable'] is None
+        assert self.bot.send_message(1, 'Spam') == (True, '')
+
+    def test_other_methods_not_checked(self):
+        self.bot._deliverability.mark(1, 'kicked')
+        assert self.bot.delete_message(1, 1) == (True, '')
+
+
+class ChatMigrationTest(AnyHandlerBotCase):
+
+    def wait_migrated(self):
+        for _ in range(100):
+            if db.ChatMigration.find_one({'migrated': True}):
+                return True
+            time.sleep(0.01)
+
+    def test_rewritten_after_error(self):
+        exc = telegram.error.ChatMigrated(-100)
+        self.bot.send_message(-1, 'Spam', raise_exception=exc)
+        assert self.bot.last_method.args['chat_id'] == -100
+        assert db.ChatMigration.find_one({'old_chat_id': -1})['new_chat_id'] == -100
+
+        self.bot.send_message(-1, 'Eggs')
+        assert self.bot.last_method.args['chat_id'] == -100
+        assert self.bot.last_method.attempts == 1
+        assert self.wait_migrated()
+
+    def test_registered_by_update(self):
+        self.bot.receive_message(chat__id=-1, chat__type='group', migrate_to_chat_id=-100)
+        assert self.bot._migrations.resolve(-1) == -100
+        assert self.wait_migrated()
+
+    def test_storage_migrated(self):
+        self.bot.receive_message('Spam', chat__id=-1, chat__type='group')
+        db.Outbox.create({
+            'method': 'send_message', 'args': {'chat_id': -1, 'text': 'Spam'}, 'chat_id': -1,
+            'status': 'pending', 'attempts': 0,
+        })
+        db.ChatMigration.create({'old_chat_id': -1, 'new_chat_id': -100, 'migrated': False})
+        self.bot._migrations.migrate_storage(-1, -100)
+        assert db.Chat.find_one()['id'] == -100
+        assert db.Message.find_one()['chat']['id'] == -100
+        assert db.Outbox.find_one()['args']['chat_id'] == -100
+        assert db.ChatMigration.find_one()['migrated']
+
+    def test_supergroup_already_stored(self):
+        self.bot.receive_message('Spam', chat__id=-1, chat__type='group')
+        self.bot.receive_message('Spam', chat__id=-100, chat__type='supergroup')
+        self.bot._migrations.migrate_storage(-1, -100)
+        assert db.Chat.count() == 1
+        assert db.Chat.find_one()['id'] == -100
+
+    def test_interrupted_resumed_once(self):
+        db.ChatMigration.create({'old_chat_id': -1, 'new_chat_id': -100, 'migrated': False})
+        registry = ChatMigrationRegistry()
+        scheduled = []
+        registry._schedule = lambda old_chat_id, new_chat_id: scheduled.append(old_chat_id)
+        find = db.ChatMigration.find
+
+        def slow_find(query=None):
+            time.sleep(0.05)
+            return find(query)
+
+        db.ChatMigration.find = slow_find
+        threads = [threading.Thread(target=registry.resolve, args=(-1,)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del db.ChatMigration.find
+        assert scheduled == [-1]
+
+
+class MediaGroupTest(AnyHandlerBotCase):
+
+    def test_one_call(self):
+        results = self.bot.send_media_group(1, ['spam_id', b'eggs'])
+        assert results == [(True, '')]
+        media = self.bot.last_method.args['media']
+        assert [item.type for item in media] == ['photo', 'photo']
+
+    def test_split(self):
+        method = self.bot._api_methods['send_media_group']
+        media = [telegram.InputMediaPhoto(str(i)) for i in range(11)]
+        media += [telegram.InputMediaDocument(str(i)) for i in range(2)]
+        groups = method.split(media)
+        assert [len(group) for group in groups] == [9, 2, 2]
+        assert groups[1][1].media == '10'
+        assert groups[2][0].type == 'document'
+
+    def test_lone_item(self):
+        media = [
+            telegram.InputMediaPhoto('spam_id'), telegram.InputMediaPhoto('eggs_id'),
+            telegram.InputMediaDocument(b'ham', caption='Ham'),
+        ]
+        results = self.bot.send_media_group(1, media)
+        assert len(results) == 2
+        assert all(success for success, response in results)
+        assert self.bot.last_method.method is self.bot._api_methods['send_document']
+        assert self.bot.last_method.args['caption'] == 'Ham'
+        assert self.bot.last_method.args['document'].read() == b'ham'
+
+    def test_animation_not_grouped(self):
+        media = [
+            telegram.InputMediaPhoto('spam_id'), telegram.InputMediaAnimation('eggs_id'),
+            telegram.InputMediaPhoto('ham_id'), telegram.InputMediaPhoto('bacon_id'),
+        ]
+        method = self.bot._api_methods['send_media_group']
+        assert [len(group) for group in method.split(media)] == [1, 1, 2]
+        results = self.bot.send_media_group(1, media[:2])
+        assert len(results) == 2
+        assert self.bot.last_method.method is self.bot._api_methods['send_animation']
+        assert self.bot.last_method.args['animation'] == 'eggs_id'
+
+    def test_single_item(self):
+        results = self.bot.send_media_group(1, ['spam_id'])
+        assert results == [(True, '')]
+
+    def test_calls(self):
+        results = self.bot.send_media_group(1, ['spam_id'] * 12, reply_to=5)
+        assert len(results) == 2
+        # the last call is of the second group, only the first one is a reply
+        assert len(self.bot.last_method.args['media']) == 2
+        assert self.bot.last_method.args['reply_to_message_id'] is None
+
+
+class FileIdCacheTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        file_id_cache.clear()
+
+    def test_cached_file_id_sent(self):
+        db.FileId.create({
+            'file_type': 'photo', 'hash': get_content_hash(b'spam'), 'file_id': 'spam_id',
+        })
+        self.bot.send_photo(1, b'spam')
+        assert self.bot.last_method.args['photo'] == 'spam_id'
+
+    def test_uploaded_file_id_stored(self):
+        method = self.bot._api_methods['send_photo']
+        record = self.bot._new_api_call(method)
+        method.call(record, chat_id=1, photo=b'eggs')
+        assert record.file_hash == get_content_hash(b'eggs')
+
+        record.success = True
+        record.response = telegram.Message.de_json({
+            'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+            'photo': [
+                {'file_id': 'small_id', 'file_unique_id': 's', 'width': 9, 'height': 9},
+                {'file_id': 'eggs_id', 'file_unique_id': 'e', 'width': 99, 'height': 99},
+            ],
+        }, None)
+        method.handle_result(record)
+        file_id_cache.clear()
+        assert file_id_cache.get('photo', record.file_hash) == 'eggs_id'
+
+    def test_file_id_stored_once(self):
+        file_id_cache.set('photo', 'spam_hash', 'spam_id')
+        file_id_cache.set('photo', 'spam_hash', 'eggs_id')
+        assert db.FileId.count({'hash': 'spam_hash'}) == 1
+        assert db.FileId.find_one({'hash': 'spam_hash'})['file_id'] == 'eggs_id'
+
+    def test_used_files_kept(self):
+        file_id_cache.size = 2
+        file_id_cache.set('photo', 'spam_hash', 'spam_id')
+        file_id_cache.set('photo', 'eggs_hash', 'eggs_id')
+        file_id_cache.get('photo', 'spam_hash')
+        file_id_cache.set('photo', 'ham_hash', 'ham_id')
+        file_id_cache.size = 1000
+        assert ('photo', 'spam_hash') in file_id_cache._memory
+        assert ('photo', 'eggs_hash') not in file_id_cache._memory
+
+    def test_file_id_not_hashed(self):
+        self.bot.send_photo(1, 'spam_id')
+        assert self.bot.last_method.args['photo'] == 'spam_id'
+        assert self.bot.last_method.file_hash is None
+
+
+class ReadOnlyMethodTest(AnyHandlerBotCase):
+
+    def test_cached(self):
+        self.bot.get_chat(1)
+        assert self.bot.get_chat(1) == (True, '')
+        assert self.bot.last_method.attempts == 0
+        self.bot.get_chat(2)
+        assert self.bot.last_method.attempts == 1
+
+    def test_invalidated_by_update(self):
+        self.bot.get_chat_member(-1, 1)
+        self.bot.receive_message(chat__id=-1, chat__type='group', new_chat_title='Spam')
+        self.bot.get_chat_member(-1, 1)
+        assert self.bot.last_method.attempts == 1
+
+    def test_me_stored(self):
+        settings.tg_api_token = '1:spam'
+        user = {'id': 1, 'is_bot': True, 'first_name': 'Spam', 'username': 'spam_bot'}
+        db.State.set('me', {'user': user, 'saved_at': time.time()})
+        success, me = self.bot.get_me()
+        assert me.username == 'spam_bot'
+        assert self.bot.last_method.attempts == 0
+
+    def test_me_of_other_bot(self):
+        settings.tg_api_token = '2:eggs'
+        user = {'id': 1, 'is_bot': True, 'first_name': 'Spam', 'username': 'spam_bot'}
+        db.State.set('me', {'user': user, 'saved_at': time.time()})
+        self.bot.get_me()
+        assert self.bot.last_method.attempts == 1
+
+
+class CleanupTest(AnyHandlerBotCase):
+
+    def test_pairs(self):
+        results = self.bot.delete_messages([(1, 1), (1, 2), (2, 1), (1, 1)])
+        assert results['deleted'] == 3
+
+    def test_missing(self):
+        exc = telegram.error.BadRequest('Message to delete not found')
+        cleanup = Cleanup(self.bot, [(1, 1)])
+        record = ApiCall(cleanup.method, raise_exception=exc)
+        self.bot._new_api_call = lambda method: record
+        assert cleanup.run()['missing'] == 1
+        assert record.attempts == 1
+
+    def test_query(self):
+        self.bot.receive_message('Spam', chat__id=1)
+        self.bot.receive_message('Eggs', chat__id=2)
+        self.bot._deliverability.mark(2, 'blocked')
+        results = self.bot.delete_messages(model=db.Message, query=lambda: {}, delete_objects=True)
+        assert results['deleted'] == 1
+        assert results['skipped'] == 1
+        assert db.Message.count() == 1
+
+    def test_schedule_mode(self):
+        settings.api_retry_mode = 'schedule'
+        exc = telegram.error.NetworkError('Bad Gateway')
+        cleanup = Cleanup(self.bot, [(1, 1)])
+        record = ApiCall(cleanup.method, raise_exception=exc)
+        self.bot._new_api_call = lambda method: record
+        settings.network_error_wait = 0.01
+        assert cleanup.run()['deleted'] == 1
+        assert record.attempts == 2
+
+    def test_job(self):
+        cleanup = Cleanup(self.bot, [(1, 1)])
+        self.bot._job_queue_wrapper.run_once(cleanup.run_job, 0)
+        self.bot._job_queue_wrapper._wrapped_callbacks[-1]()
+        assert self.bot.last_method.args == {'chat_id': 1, 'message_id': 1}
+
+
+class ApiStatsTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        service_cache['stats']['api'].clear()
+
+    def test_counted(self):
+        self.bot.send_message(1, 'Spam')
+        exc = telegram.error.RetryAfter(0)
+        self.bot.send_message(1, 'Spam', raise_exception=exc)
+        stats = get_api_stats()['send_message']
+        assert stats['calls'] == 2
+        assert stats['successes'] == 2
+        assert stats['retries'] == 1
+        assert stats['retry_after'] == 1
+        assert stats['p99'] >= 1
+
+    def test_reported(self):
+        self.bot.send_message(1, 'Spam')
+        reports = get_api_reports()
+        assert reports[0].startswith('send_message: 1 calls, 0 failed, 0 retries')
+        assert get_api_reports() == []
+
+    def test_counted_concurrently(self):
+        threads = [
+            threading.Thread(target=self.bot.send_message, args=(1, 'Spam')) for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert get_api_stats()['send_message']['calls'] == 10
+
+
 class ReportTest(AnyHandlerBotCase):
 
     def setUp(self):
@@ -0,0 +1,55 @@
+from meetg.benchmarking import (
+    generate_updates, get_multiplier, get_percentile, get_replay_query, LatencyStats,
+)
+from meetg.testing import BaseTestCase, TgBotMock
+
+
+class PercentileTest(BaseTestCase):
+
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        assert get_percentile(values, 50) == 50
+        assert get_percentile(values, 99) == 99
+        assert get_percentile(values, 100) == 100
+
+    def test_empty(self):
+        assert get_percentile([], 50) == 0
+
+    def test_latency_summary(self):
+        stats = LatencyStats()
+        stats.start()
+        for duration in (0.001, 0.002, 0.003):
+            stats.add('reply_any', duration)
+        stats.finish()
+        summary = stats.get_summary()
+        assert summary['updates'] == 3
+        assert summary['handlers']['reply_any']['count'] == 3
+        assert summary['handlers']['reply_any']['max_ms'] == 3.0
+
+
+class ReplayQueryTest(BaseTestCase):
+
+    def test_time_range(self):
+        query = get_replay_query(since=10, until=20)
+        assert query == {'_created_at': {'$gte': 10, '$lt': 20}}
+
+    def test_chat_and_type(self):
+        query = get_replay_query(chat_id=5, update_type='message')
+        assert {'message.chat.id': 5} in query['$or']
+        assert query['message'] == {'$exists': True}
+
+    def test_speed(self):
+        assert get_multiplier('max') is None
+        assert get_multiplier('real') == 1.0
+        assert get_multiplier('2.5') == 2.5
+        for speed in ('0', '-1', 'nan', 'spam'):
+            with self.assertRaises(ValueError):
+                get_multiplier(speed)
+
+
+class GenerateUpdatesTest(BaseTestCase):
+
+    def test_number(self):
+        updates = generate_updates(TgBotMock(), 50)
+        assert len(updates) == 50
+        assert all(update.effective_message for update in updates)
@@ -0,0 +1,59 @@
+import threading, time
+
+from meetg.caching import ApiResponseCache
+from meetg.testing import BaseTestCase
+
+
+class ApiResponseCacheTest(BaseTestCase):
+
+    def test_cached(self):
+        cache = ApiResponseCache()
+        calls = []
+        call = lambda: calls.append(1) or (True, 'Spam')
+        assert cache.get_or_call('key', 1, 60, call) == (True, 'Spam')
+        assert cache.get_or_call('key', 1, 60, call) == (True, 'Spam')
+        assert len(calls) == 1
+
+    def test_failure_not_cached(self):
+        cache = ApiResponseCache()
+        cache.get_or_call('key', 1, 60, lambda: (False, 'Spam'))
+        assert cache.get_or_call('key', 1, 60, lambda: (True, 'Eggs')) == (True, 'Eggs')
+
+    def test_expired(self):
+        cache = ApiResponseCache()
+        cache.get_or_call('key', 1, 0.01, lambda: (True, 'Spam'))
+        time.sleep(0.02)
+        assert cache.get_or_call('key', 1, 60, lambda: (True, 'Eggs')) == (True, 'Eggs')
+
+    def test_invalidated(self):
+        cache = ApiResponseCache()
+        cache.get_or_call('key', 1, 60, lambda: (True, 'Spam'))
+        cache.invalidate(1)
+        assert cache.get_or_call('key', 1, 60, lambda: (True, 'Eggs')) == (True, 'Eggs')
+
+    def test_single_flight(self):
+        cache = ApiResponseCache()
+        calls = []
+
+        def call():
+            calls.append(1)
+            time.sleep(0.05)
+            return True, 'Spam'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_call('key', 1, 60, call)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == [(True, 'Spam')] * 5
+
+    def test_size(self):
+        cache = ApiResponseCache(size=1)
+        cache.get_or_call('key', 1, 60, lambda: (True, 'Spam'))
+        cache.get_or_call('other key', 2, 60, lambda: (True, 'Eggs'))
+        assert cache.get_or_call('key', 1, 60, lambda: (True, 'Ham')) == (True, 'Ham')
@@ -0,0 +1,63 @@
+import telegram
+
+import settings
+from meetg.tests.base import AnyHandlerBot, AnyHandlerBotCase
+
+
+class CoalesceTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.coalesce_messages_window = 0.05
+        self.bot = AnyHandlerBot()
+        self.method = self.bot._api_methods['send_message']
+
+    def send(self, chat_id, text, raise_exception=None, **kwargs):
+        record = self.bot._new_api_call(self.method, raise_exception)
+        future = self.method.easy_call(record, chat_id, text, **kwargs)
+        return record, future
+
+    def test_merged(self):
+        first, first_future = self.send(1, 'Spam')
+        second, second_future = self.send(1, 'Eggs')
+        assert first_future is second_future
+        assert first_future.result(5) == (True, '')
+        assert first.args['text'] == 'Spam\n\nEggs'
+        assert second.success
+
+    def test_other_chat_not_merged(self):
+        first, first_future = self.send(1, 'Spam')
+        second, second_future = self.send(2, 'Eggs')
+        first_future.result(5)
+        second_future.result(5)
+        assert first.args['text'] == 'Spam'
+        assert second.args['text'] == 'Eggs'
+
+    def test_other_parse_mode_not_merged(self):
+        first, first_future = self.send(1, 'Spam')
+        second, second_future = self.send(1, '<b>Eggs</b>', html=True)
+        assert first_future is not second_future
+        first_future.result(5)
+        second_future.result(5)
+        assert first.args['text'] == 'Spam'
+
+    def test_length_limit(self):
+        first, first_future = self.send(1, 'S' * 4000)
+        second, second_future = self.send(1, 'E' * 100)
+        assert first_future is not second_future
+        first_future.result(5)
+        assert len(first.args['text']) == 4000
+
+    def test_disabled(self):
+        settings.coalesce_messages_window = 0
+        self.bot = AnyHandlerBot()
+        assert self.bot.send_message(1, 'Spam') == (True, '')
+
+    def test_retried_in_schedule_mode(self):
+        settings.api_retry_mode = 'schedule'
+        settings.network_error_wait = 0.01
+        exc = telegram.error.NetworkError('Bad Gateway')
+        # more chats than delay queue workers, each waiting for a retry in the delay queue
+        futures = [self.send(chat_id, 'Spam', exc)[1] for chat_id in range(10)]
+        for future in futures:
+            assert future.result(5) == (True, '')
@@ -0,0 +1,58 @@
+import time
+
+import telegram
+
+import settings
+from meetg.tests.base import AnyHandlerBot, AnyHandlerBotCase
+
+
+class DebounceTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.edit_debounce_interval = 0.1
+        self.bot = AnyHandlerBot()
+        self.method = self.bot._api_methods['edit_message_text']
+
+    def edit(self, text, message_id=1, raise_exception=None):
+        record = self.bot._new_api_call(self.method, raise_exception)
+        future = self.method.easy_call(record, text, 1, message_id)
+        return record, future
+
+    def test_only_latest_sent(self):
+        first, first_future = self.edit('1%')
+        first_future.result(5)
+        second, second_future = self.edit('2%')
+        third, third_future = self.edit('3%')
+        assert second_future is third_future
+        assert third_future.result(5) == (True, '')
+        assert third.attempts == 1
+        assert second.attempts == 0
+
+    def test_interval(self):
+        self.edit('1%')[1].result(5)
+        started_at = time.monotonic()
+        self.edit('2%')[1].result(5)
+        assert time.monotonic() - started_at >= 0.05
+
+    def test_same_text_skipped(self):
+        self.edit('1%')[1].result(5)
+        record, future = self.edit('1%')
+        assert future.result(5) == (True, None)
+        assert record.attempts == 0
+
+    def test_other_message_not_debounced(self):
+        first, first_future = self.edit('1%')
+        second, second_future = self.edit('1%', message_id=2)
+        assert first_future is not second_future
+        second_future.result(5)
+        assert second.attempts == 1
+
+    def test_retried_in_schedule_mode(self):
+        settings.api_retry_mode = 'schedule'
+        settings.network_error_wait = 0.01
+        exc = telegram.error.NetworkError('Bad Gateway')
+        # more messages than delay queue workers, each waiting for a retry in the delay queue
+        futures = [self.edit('Spam', message_id, exc)[1] for message_id in range(10)]
+        for future in futures:
+            assert future.result(5) == (True, '')
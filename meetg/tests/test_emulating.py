@@ -0,0 +1,72 @@
+import http.client, io
+
+import telegram
+
+from meetg.emulating import MockBotApiServer
+from meetg.testing import BaseTestCase
+
+
+class MockBotApiServerTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = MockBotApiServer()
+        self.server.start()
+        self.tgbot = telegram.Bot('123:spam', base_url=self.server.base_url)
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    def test_get_me(self):
+        me = self.tgbot.get_me()
+        assert me.username == 'mock_username'
+        assert me.id == 123
+
+    def test_keep_alive(self):
+        host, port = self.server._http.server_address
+        connection = http.client.HTTPConnection(host, port)
+        for _ in range(2):
+            connection.request('POST', '/bot123:spam/getMe')
+            response = connection.getresponse()
+            response.read()
+            assert not response.will_close
+        connection.close()
+        assert self.server.calls['getMe'] == 2
+
+    def test_send_message(self):
+        message = self.tgbot.send_message(1, 'Spam')
+        assert message.text == 'Spam'
+        assert message.chat.id == 1
+        assert self.server.calls['sendMessage'] == 1
+
+    def test_send_photo(self):
+        message = self.tgbot.send_photo(1, io.BytesIO(b'spam'))
+        assert message.photo[-1].file_id
+
+    def test_send_media_group(self):
+        media = [telegram.InputMediaPhoto('spam_id'), telegram.InputMediaVideo(b'eggs')]
+        messages = self.tgbot.send_media_group(1, media)
+        assert messages[0].photo[0].file_id == 'spam_id'
+        assert messages[1].video.file_id
+
+    def test_updates(self):
+        self.server.generate_updates(3)
+        updates = self.tgbot.get_updates()
+        assert len(updates) == 3
+        assert len(self.tgbot.get_updates(offset=updates[-1].update_id + 1, timeout=0)) == 0
+
+    def test_retry_after(self):
+        self.server.error_rates = {'retry_after': 1}
+        with self.assertRaises(telegram.error.RetryAfter):
+            self.tgbot.send_message(1, 'Spam')
+
+    def test_migrate(self):
+        self.server.error_rates = {'migrate': 1}
+        with self.assertRaises(telegram.error.ChatMigrated):
+            self.tgbot.send_message(-1, 'Spam')
+
+    def test_server_error(self):
+        self.server.error_rates = {'server_error': 1}
+        with self.assertRaises(telegram.error.NetworkError):
+            self.tgbot.send_message(1, 'Spam')
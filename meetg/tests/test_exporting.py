@@ -0,0 +1,72 @@
+import urllib.request, urllib.error
+
+from meetg.exporting import MetricsServer, MetricsWriter, get_metrics
+from meetg.stats import ApiMethodStats, Histogram, JobStats, MinuteCounter, service_cache
+from meetg.storage import db
+from meetg.tests.base import AnyHandlerBotCase
+
+
+class MetricsTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        for key in ('update', 'api', 'job', 'storage'):
+            service_cache['stats'][key].clear()
+
+    def test_updates(self):
+        service_cache['stats']['update'].init(MinuteCounter)
+        service_cache['stats']['update']['message'].add(count=3)
+        metrics = get_metrics(self.bot)
+        assert '# TYPE meetg_updates counter' in metrics
+        assert 'meetg_updates_total{type="message"} 3' in metrics
+        assert metrics.endswith('# EOF\n')
+
+    def test_histograms(self):
+        service_cache['stats']['api'].init(ApiMethodStats)
+        service_cache['stats']['api']['send_message'].add_call(True, 2, 0.05)
+        service_cache['stats']['job'].init(JobStats)
+        service_cache['stats']['job']['clean'].add_run(2, lag=0.5)
+        metrics = get_metrics(self.bot)
+        assert 'meetg_api_retries_total{method="send_message"} 1' in metrics
+        assert 'meetg_api_latency_seconds_bucket{method="send_message",le="+Inf"} 1' in metrics
+        assert 'meetg_api_latency_seconds_bucket{method="send_message",le="0.001"} 0' in metrics
+        assert 'meetg_api_latency_seconds_count{method="send_message"} 1' in metrics
+        assert 'meetg_job_duration_seconds_sum{job="clean"} 2' in metrics
+        assert 'meetg_job_lag_seconds_count{job="clean"} 1' in metrics
+
+    def test_histogram_count_from_buckets(self):
+        histogram = Histogram()
+        histogram.add(0.05)
+        histogram.add(10 ** 6)
+        # a copy made while another thread has added to the buckets only
+        histogram.count = 1
+        writer = MetricsWriter()
+        writer.histogram('spam', histogram)
+        assert 'spam_bucket{le="+Inf"} 2' in writer.lines
+        assert 'spam_count 2' in writer.lines
+
+    def test_storage(self):
+        db.State.find_one({'key': 'spam'})
+        metrics = get_metrics(self.bot)
+        line = 'meetg_storage_latency_seconds_count{model="State",operation="find_one"} 1'
+        assert line in metrics
+
+    def test_sys_and_queues(self):
+        metrics = get_metrics(self.bot)
+        assert 'meetg_process_resident_memory_bytes ' in metrics
+        assert 'meetg_queue_depth{queue="delay"} ' in metrics
+
+    def test_server(self):
+        server = MetricsServer(self.bot)
+        server.start()
+        try:
+            with urllib.request.urlopen(server.url) as response:
+                assert response.headers['Content-Type'].startswith('application/openmetrics-text')
+                assert response.read().decode().endswith('# EOF\n')
+            try:
+                urllib.request.urlopen(server.url.replace('/metrics', '/spam'))
+                assert False
+            except urllib.error.HTTPError as exc:
+                assert exc.code == 404
+        finally:
+            server.stop()
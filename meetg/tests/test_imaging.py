@@ -0,0 +1,97 @@
+import io, threading
+
+from PIL import Image
+
+import settings
+from meetg.imaging import ImagePipeline, make_thumb, process_photo
+from meetg.testing import BaseTestCase
+from meetg.tests.base import AnyHandlerBotCase
+
+
+def get_image_content(size, mode='RGB', fmt='PNG'):
+    output = io.BytesIO()
+    Image.new(mode, size, 'red').save(output, fmt)
+    return output.getvalue()
+
+
+class ProcessTest(BaseTestCase):
+
+    def test_photo_resized(self):
+        processed = process_photo(get_image_content((4000, 1000)), 2000, 85)
+        image = Image.open(io.BytesIO(processed))
+        assert image.format == 'JPEG'
+        assert image.size == (2000, 500)
+
+    def test_small_photo_not_resized(self):
+        processed = process_photo(get_image_content((100, 50), mode='RGBA'), 2000, 85)
+        assert Image.open(io.BytesIO(processed)).size == (100, 50)
+
+    def test_exif_stripped(self):
+        output = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x010f] = 'Spam camera'
+        Image.new('RGB', (10, 10)).save(output, 'JPEG', exif=exif)
+        processed = process_photo(output.getvalue(), 2000, 85)
+        assert not Image.open(io.BytesIO(processed)).getexif()
+
+    def test_thumb(self):
+        thumb = make_thumb(get_image_content((1000, 500)), 85)
+        image = Image.open(io.BytesIO(thumb))
+        assert image.format == 'JPEG'
+        assert image.size == (320, 160)
+
+
+class PipelineTest(BaseTestCase):
+
+    def test_processed_in_pool(self):
+        pipeline = ImagePipeline(workers=1)
+        processed = pipeline.process_photo(get_image_content((10, 10)))
+        pipeline.shutdown()
+        assert Image.open(io.BytesIO(processed)).format == 'JPEG'
+
+    def test_not_image(self):
+        pipeline = ImagePipeline(workers=1)
+        assert pipeline.process_photo(b'spam') == b'spam'
+        assert pipeline.make_thumb(b'spam') is None
+        pipeline.shutdown()
+
+    def test_one_pool(self):
+        pipeline = ImagePipeline(workers=1)
+        executors = []
+        threads = [
+            threading.Thread(target=lambda: executors.append(pipeline._get_executor()))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pipeline.shutdown()
+        assert len(set(executors)) == 1
+
+
+class SendTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.process_images = True
+
+    def test_photo_processed(self):
+        self.bot.send_photo(1, get_image_content((10, 10)))
+        photo = self.bot.last_method.args['photo']
+        assert Image.open(photo).format == 'JPEG'
+        assert photo.name == 'photo.jpg'
+
+    def test_not_processed_photo_name_kept(self):
+        photo = io.BytesIO(b'spam')
+        photo.name = 'spam.webp'
+        self.bot.send_photo(1, photo)
+        assert self.bot.last_method.args['photo'].name == 'spam.webp'
+
+    def test_document_thumb(self):
+        self.bot.send_document(1, get_image_content((10, 10)))
+        assert Image.open(io.BytesIO(self.bot.last_method.args['thumb'])).format == 'JPEG'
+
+    def test_not_image_document_without_thumb(self):
+        self.bot.send_document(1, b'spam')
+        assert 'thumb' not in self.bot.last_method.args
@@ -0,0 +1,71 @@
+import time
+
+import settings
+from meetg.retrying import CircuitBreaker, get_backoff_delay
+from meetg.stats import get_breaker_reports, service_cache
+from meetg.testing import BaseTestCase
+
+
+class BackoffTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.network_error_wait = 2
+        settings.network_error_max_wait = 60
+
+    def test_exponential(self):
+        settings.network_error_jitter = False
+        delays = [get_backoff_delay(attempt) for attempt in range(1, 8)]
+        assert delays == [2, 4, 8, 16, 32, 60, 60]
+
+    def test_jitter(self):
+        settings.network_error_jitter = True
+        for _ in range(100):
+            assert 4 <= get_backoff_delay(3) <= 8
+
+
+class CircuitBreakerTest(BaseTestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, timeout=60)
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        assert breaker.trips == 1
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(threshold=2, timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(threshold=1, timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # only one probe at a time
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(threshold=1, timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.trips == 2
+
+    def test_report(self):
+        breaker = CircuitBreaker(threshold=1, timeout=60)
+        service_cache['stats']['breaker']['spam_method'] = breaker
+        breaker.record_failure()
+        reports = get_breaker_reports()
+        del service_cache['stats']['breaker']['spam_method']
+        assert 'spam_method circuit breaker is open, tripped 1 times' in reports
@@ -0,0 +1,64 @@
+from telegram.ext import CommandHandler, Filters, MessageHandler, TypeHandler
+from telegram import Update
+
+from meetg.factories import MessageUpdateFactory
+from meetg.routing import HandlerRouter
+from meetg.testing import BaseTestCase, TgBotMock
+
+
+class CountingCommandHandler(CommandHandler):
+    """CommandHandler which counts how many times it was checked"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked = 0
+
+    def check_update(self, update):
+        self.checked += 1
+        return super().check_update(update)
+
+
+class HandlerRouterTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.factory = MessageUpdateFactory(TgBotMock(), 'message')
+
+    def _route(self, handlers, text):
+        router = HandlerRouter(handlers)
+        update = self.factory.create(text=text)
+        handler, check = router.route(update)
+        return handler
+
+    def test_first_match_wins(self):
+        handlers = (
+            MessageHandler(Filters.text, lambda u, c: None),
+            CommandHandler('start', lambda u, c: None),
+        )
+        assert self._route(handlers, '/start') is handlers[0]
+
+    def test_command_routed(self):
+        handlers = (
+            CommandHandler('help', lambda u, c: None),
+            CommandHandler('start', lambda u, c: None),
+            MessageHandler(Filters.text, lambda u, c: None),
+        )
+        assert self._route(handlers, '/start') is handlers[1]
+        assert self._route(handlers, '/START@mock_username now') is handlers[1]
+        assert self._route(handlers, 'start') is handlers[2]
+
+    def test_other_commands_not_checked(self):
+        handlers = [CountingCommandHandler(f'cmd{i}', lambda u, c: None) for i in range(20)]
+        assert self._route(handlers, '/cmd7') is handlers[7]
+        assert sum(handler.checked for handler in handlers) == 1
+
+    def test_unknown_handler_always_checked(self):
+        handlers = (
+            CommandHandler('start', lambda u, c: None),
+            TypeHandler(Update, lambda u, c: None),
+        )
+        assert self._route(handlers, 'Spam') is handlers[1]
+
+    def test_no_match(self):
+        handlers = (CommandHandler('start', lambda u, c: None), )
+        assert self._route(handlers, '/stop') is None
@@ -0,0 +1,24 @@
+import threading
+
+from meetg.scheduling import DelayQueue
+from meetg.testing import BaseTestCase
+
+
+class DelayQueueTest(BaseTestCase):
+
+    def test_order(self):
+        queue = DelayQueue(workers=1)
+        called = []
+        done = threading.Event()
+        queue.schedule(0.05, called.append, 2)
+        queue.schedule(0.01, called.append, 1)
+        queue.schedule(0.1, done.set)
+        assert done.wait(5)
+        assert called == [1, 2]
+
+    def test_failed_function_not_stops_queue(self):
+        queue = DelayQueue(workers=1)
+        done = threading.Event()
+        queue.schedule(0, lambda: 1 / 0)
+        queue.schedule(0.01, done.set)
+        assert done.wait(5)
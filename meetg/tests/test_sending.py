@@ -0,0 +1,63 @@
+import threading
+
+import telegram
+
+import settings
+from meetg.sending import serialize_args
+from meetg.storage import db
+from meetg.testing import BaseTestCase
+from meetg.tests.base import AnyHandlerBot, AnyHandlerBotCase
+from meetg.utils import get_current_unixtime
+
+
+class SerializeTest(BaseTestCase):
+
+    def test_markup(self):
+        markup = telegram.ReplyKeyboardMarkup([['Spam']])
+        args = serialize_args({'chat_id': 1, 'reply_markup': markup})
+        assert args['reply_markup']['keyboard'][0][0]['text'] == 'Spam'
+
+    def test_file_content(self):
+        assert serialize_args({'chat_id': 1, 'photo': b'spam'}) is None
+
+
+class OutboxTest(AnyHandlerBotCase):
+
+    def setUp(self):
+        super().setUp()
+        settings.outbox_methods = ('send_message', 'send_photo')
+        self.bot = AnyHandlerBot()
+
+    def test_sent(self):
+        future = self.bot.send_message(1, 'Spam')
+        assert future.result(5) == (True, '')
+        assert db.Outbox.count() == 0
+
+    def test_failed_kept(self):
+        settings.api_attempts = 1
+        future = self.bot.send_message(1, 'Spam', raise_exception=telegram.error.BadRequest('Eggs'))
+        assert future.result(5) == (False, 'Eggs')
+        entry = db.Outbox.find_one({'status': 'failed'})
+        assert entry['args']['text'] == 'Spam'
+
+    def test_failed_reported_for_day(self):
+        for modified_at in (1, get_current_unixtime()):
+            db.Outbox.create({'method': 'send_message', 'args': {}, 'status': 'failed'})
+            db.Outbox._storage.update({'_modified_at': None}, {'_modified_at': modified_at})
+        assert db.Outbox.get_day_report() == '1 calls failed to be sent from the outbox'
+
+    def test_resumed(self):
+        db.Outbox.create({
+            'method': 'send_message', 'args': {'chat_id': 1, 'text': 'Spam'}, 'chat_id': 1,
+            'status': 'sending', 'attempts': 1,
+        })
+        self.bot._outbox.start()
+        for _ in range(100):
+            if not db.Outbox.count():
+                break
+            threading.Event().wait(0.05)
+        assert db.Outbox.count() == 0
+
+    def test_not_serializable_sent_directly(self):
+        assert self.bot.send_photo(1, b'spam') == (True, '')
+        assert db.Outbox.count() == 0
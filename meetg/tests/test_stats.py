@@ -0,0 +1,117 @@
+import datetime, time
+
+from meetg.stats import (
+    ApiMethodStats, Histogram, JobStats, MinuteCounter, _SaveTimeJobQueueWrapper, service_cache,
+)
+from meetg.testing import BaseTestCase
+
+
+class HistogramTest(BaseTestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.add(i / 100)
+        assert 0.5 <= histogram.get_percentile(50) <= 0.75
+        assert 0.99 <= histogram.get_percentile(99) <= 1
+        assert histogram.get_percentile(100) == 1
+
+    def test_empty(self):
+        assert Histogram().get_percentile(50) == 0
+
+    def test_diff(self):
+        histogram = Histogram()
+        histogram.add(10)
+        snapshot = histogram.copy()
+        histogram.add(0.01)
+        diff = histogram - snapshot
+        assert diff.count == 1
+        assert diff.get_percentile(99) <= 0.015
+
+
+class ApiMethodStatsTest(BaseTestCase):
+
+    def test_since_report(self):
+        stats = ApiMethodStats()
+        stats.add_call(True, 1, 0.1)
+        stats.add_call(False, 3, 0.2)
+        assert stats.get_since_report(mark_reported=True)['retries'] == 2
+        stats.add_call(True, 1, 0.1)
+        since_report = stats.get_since_report()
+        assert since_report['calls'] == 1
+        assert since_report['failures'] == 0
+        assert stats.snapshot()['calls'] == 3
+
+
+class MinuteCounterTest(BaseTestCase):
+
+    def test_day_count(self):
+        counter = MinuteCounter()
+        now = 1000000 * 60
+        counter.add(now - 24 * 60 * 60)
+        counter.add(now - 60 * 60)
+        counter.add(now, count=2)
+        assert counter.get_day_count(now) == 3
+
+    def test_slot_reused(self):
+        counter = MinuteCounter()
+        now = 1000000 * 60
+        counter.add(now - 24 * 60 * 60)
+        counter.add(now)
+        assert counter.get_day_count(now) == 1
+        assert counter.get_day_count(now + 24 * 60 * 60) == 0
+
+
+class JobStatsTest(BaseTestCase):
+
+    def test_since_report(self):
+        stats = JobStats()
+        stats.add_run(1, lag=0.5)
+        stats.add_run(2)
+        snapshot = stats.get_since_report(mark_reported=True)
+        assert snapshot['runs'] == 2
+        assert snapshot['lag'].count == 1
+        assert snapshot['duration'].max == 2
+        assert stats.get_since_report()['runs'] == 0
+
+    def test_max_since_report(self):
+        stats = JobStats()
+        stats.add_run(100)
+        stats.get_since_report(mark_reported=True)
+        stats.add_run(0.01)
+        assert stats.get_since_report(mark_reported=True)['duration'].max == 0.01
+        assert stats.get_since_report()['duration'].max == 0
+        assert stats.duration.max == 100
+
+
+class JobMock:
+    id = 'spam'
+
+    def __init__(self, next_t):
+        self.next_t = next_t
+
+
+class JobQueueMock:
+
+    def run_repeating(self, callback, *args, **kwargs):
+        return JobMock(datetime.datetime.fromtimestamp(time.time() - 2))
+
+
+class ContextMock:
+
+    def __init__(self, job):
+        self.job = job
+
+
+class JobWrapperTest(BaseTestCase):
+
+    def test_lag(self):
+        service_cache['stats']['job'].clear()
+        wrapper = _SaveTimeJobQueueWrapper(JobQueueMock())
+        job = wrapper.run_repeating(lambda context: None, 10)
+        next_run = datetime.datetime.fromtimestamp(time.time() + 10)
+        wrapper._wrapped_callbacks[0](ContextMock(JobMock(next_run)))
+        stats = service_cache['stats']['job']['<lambda>'].snapshot()
+        assert stats['runs'] == 1
+        assert 2 <= stats['lag'].max < 3
+        assert wrapper._planned[job.id] == next_run.timestamp()
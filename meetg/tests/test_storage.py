@@ -1,8 +1,11 @@
+import time
+
 import telegram
 from parameterized import parameterized
 
 import settings
 from meetg.botting import BaseBot
+from meetg.factories import MessageUpdateFactory
 from meetg.storage import (
     db, DefaultChatModel, DefaultMessageModel, DefaultUpdateModel, DefaultUserModel
 )
@@ -310,3 +313,40 @@ class DeleteDbObjTest(AnyHandlerBotCase):
         exception = telegram.error.Unauthorized('Forbidden: bot was kicked from the group chat')
         self.bot.send_message(-1, 'Spam', raise_exception=exception)
         assert db.Chat.find_one()['_kicked_at']
+
+
+class StateTest(AnyHandlerBotCase):
+
+    def test_set_and_get(self):
+        assert db.State.get('spam') is None
+        db.State.set('spam', 1)
+        db.State.set('spam', 2)
+        assert db.State.get('spam') == 2
+        assert db.State.count() == 1
+
+    def test_update_offset_saved(self):
+        self.bot.receive_message('Spam')
+        assert db.State.get('update_offset') == self.bot.last_update.update_id + 1
+
+    def test_update_offset_saved_periodically(self):
+        settings.update_offset_save_interval = 0.05
+        self.bot.receive_message('Spam')
+        self.bot.receive_message('Eggs')
+        assert db.State.get('update_offset') is None
+        for _ in range(100):
+            if db.State.get('update_offset'):
+                break
+            time.sleep(0.01)
+        assert db.State.get('update_offset') == self.bot.last_update.update_id + 1
+
+    def test_update_offset_flushed(self):
+        settings.update_offset_save_interval = 60
+        self.bot.receive_message('Spam')
+        self.bot._service_handler.flush_offset()
+        assert db.State.get('update_offset') == self.bot.last_update.update_id + 1
+
+    def test_duplicate_not_saved(self):
+        update = MessageUpdateFactory(self.bot._tgbot, 'message').create(text='Spam')
+        self.bot._simulate_process_update(update)
+        self.bot._simulate_process_update(update)
+        assert db.Update.count() == 1
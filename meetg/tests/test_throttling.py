@@ -0,0 +1,55 @@
+from meetg.testing import BaseTestCase
+from meetg.throttling import RateLimiter, TokenBucket
+
+
+class TokenBucketTest(BaseTestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(2, 1)
+        assert bucket.reserve(0) == 0
+        assert bucket.reserve(0) == 0
+        assert bucket.reserve(0) == 0.5
+
+    def test_refilled(self):
+        bucket = TokenBucket(1, 1)
+        assert bucket.reserve(0) == 0
+        assert bucket.reserve(5) == 5
+        assert bucket.is_idle(6)
+
+    def test_hold(self):
+        bucket = TokenBucket(1, 1)
+        bucket.hold(10)
+        assert bucket.reserve(0) == 10
+
+
+class RateLimiterTest(BaseTestCase):
+
+    def test_private_chat(self):
+        limiter = RateLimiter(private_limit=(1, 1))
+        assert limiter.reserve(1, now=0) == 0
+        assert limiter.reserve(1, now=0) == 1
+        assert limiter.reserve(2, now=0) == 0
+
+    def test_group_chat(self):
+        limiter = RateLimiter(private_limit=(1, 1), group_limit=(20, 60))
+        waits = [limiter.reserve(-1, now=0) for _ in range(21)]
+        assert waits[:20] == [0] * 20
+        assert waits[20] == 3
+
+    def test_global(self):
+        limiter = RateLimiter(global_limit=(30, 1), private_limit=(1, 1))
+        waits = [limiter.reserve(chat_id, now=0) for chat_id in range(1, 32)]
+        assert waits[:30] == [0] * 30
+        assert round(waits[30], 6) == round(1 / 30, 6)
+
+    def test_global_delay_respected_by_chat(self):
+        limiter = RateLimiter(global_limit=(1, 1), private_limit=(1, 1))
+        assert limiter.reserve(1, now=0) == 0
+        assert limiter.reserve(2, now=0) == 1
+        # chat 2 got its call at 1, so the next one is allowed only at 2
+        assert limiter.reserve(2, now=0) == 2
+
+    def test_no_limits(self):
+        limiter = RateLimiter()
+        assert limiter.reserve(1, now=0) == 0
+        assert limiter.reserve(1, now=0) == 0
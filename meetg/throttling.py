@@ -0,0 +1,111 @@
+"""
+Proactive limiting of outgoing API calls, to stay under Telegram limits
+instead of reacting to RetryAfter errors
+"""
+import threading, time
+
+import settings
+
+
+class TokenBucket:
+    """
+    Token bucket of `count` tokens refilled during `period` seconds,
+    implemented as GCRA: instead of the number of tokens it keeps only
+    the theoretical arrival time of the next call, so it can tell
+    the exact moment a call is allowed at
+    """
+    __slots__ = ('interval', 'tolerance', 'tat')
+
+    def __init__(self, count, period):
+        self.interval = period / count
+        self.tolerance = period - self.interval
+        self.tat = 0
+
+    def peek(self, at):
+        """Return the earliest time not before `at` when a call is allowed"""
+        return max(at, self.tat - self.tolerance)
+
+    def reserve(self, at):
+        """Take a token for a call at the earliest allowed time and return that time"""
+        allowed_at = self.peek(at)
+        self.tat = max(self.tat, allowed_at) + self.interval
+        return allowed_at
+
+    def hold(self, until):
+        """Don't allow calls before `until`"""
+        self.tat = max(self.tat, until + self.tolerance)
+
+    def is_idle(self, at):
+        """True if the bucket is full, so it's the same as a new one"""
+        return self.tat <= at
+
+
+class RateLimiter:
+    """
+    Global bucket for all the calls, plus a bucket per chat,
+    with different limits for private chats and groups
+    """
+    max_chat_buckets = 10000
+
+    def __init__(self, global_limit=None, private_limit=None, group_limit=None):
+        self.global_bucket = TokenBucket(*global_limit) if global_limit else None
+        self.private_limit = private_limit
+        self.group_limit = group_limit
+        self.chat_buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            settings.rate_limit_global, settings.rate_limit_private_chat,
+            settings.rate_limit_group_chat,
+        )
+
+    def _get_chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # positive ids are users, negative are groups and channels, strings are @channels
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            limit = self.private_limit if is_private else self.group_limit
+            if limit:
+                bucket = TokenBucket(*limit)
+                self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self, now):
+        if len(self.chat_buckets) > self.max_chat_buckets:
+            idle = [key for key, bucket in self.chat_buckets.items() if bucket.is_idle(now)]
+            for key in idle:
+                del self.chat_buckets[key]
+
+    def reserve(self, chat_id=None, now=None):
+        """Reserve a call to the chat and return how many seconds to wait before it"""
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            chat_bucket = self._get_chat_bucket(chat_id)
+            allowed_at = chat_bucket.peek(now) if chat_bucket else now
+            if self.global_bucket:
+                allowed_at = self.global_bucket.reserve(allowed_at)
+            if chat_bucket:
+                chat_bucket.reserve(allowed_at)
+            self._prune(now)
+
+        return allowed_at - now
+
+    def acquire(self, chat_id=None):
+        """Wait until a call to the chat is allowed"""
+        wait = self.reserve(chat_id)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def hold(self, chat_id, seconds):
+        """Pause calls to the chat, e.g. when Telegram asked to retry after some time"""
+        with self._lock:
+            bucket = self._get_chat_bucket(chat_id)
+            if bucket:
+                bucket.hold(time.monotonic() + seconds)
@@ -1,5 +1,5 @@
 import random, string, time
-from collections import namedtuple
+from collections import deque, namedtuple
 from importlib import import_module
 
 from PIL import Image
@@ -61,3 +61,26 @@ def get_update_type(update):
 def true_only(collection):
     collection_type = type(collection)
     return collection_type(item for item in collection if item)
+
+
+class BoundedSet:
+    """Set which remembers only the last added items, up to the size"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = set()
+        self._order = deque()
+
+    def add(self, item):
+        if item in self._items:
+            return
+        self._items.add(item)
+        self._order.append(item)
+        if len(self._order) > self.size:
+            self._items.discard(self._order.popleft())
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)